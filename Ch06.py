@@ -1,44 +1,94 @@
 import getpass
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import random
 import yfinance as yf
 import numpy as np
-import requests
 import os
+import time
 import datetime as dt
-from bs4 import BeautifulSoup
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
 import pandas as pd
+from http_util import HttpCache, get_with_retry
+from universe import TickerUniverse
+from llm_cache import LLMCache
+from prompt_builder import PromptBuilder
+# yfinance 的 download 每次都會重設模組層級的共用結果, 多個執行緒同時呼叫會互相覆蓋, 須依序呼叫
+yf_lock = threading.Lock()
 class StockInfo():
+  # http: 共用的 HttpCache; 股號清單由共用的 TickerUniverse 提供(有本機快照, 查詢為 O(1))
+  def __init__(self, http=None, snapshot='/content/drive/MyDrive/StockGPT/cache/universe.json'):
+    self.http = http or HttpCache()
+    self.universe = TickerUniverse.shared(snapshot, self.http)
   # 取得全部股票的股號、股名
   def stock_name(self):
-    # print("線上讀取股號、股名、及產業別")
-    response = requests.get('https://isin.twse.com.tw/isin/C_public.jsp?strMode=2')
-    url_data = BeautifulSoup(response.text, 'html.parser')
-    stock_company = url_data.find_all('tr')
-  
-    # 資料處理
-    data = [
-        (row.find_all('td')[0].text.split('\u3000')[0].strip(),
-          row.find_all('td')[0].text.split('\u3000')[1],
-          row.find_all('td')[4].text.strip())
-        for row in stock_company[2:] if len(row.find_all('td')[0].text.split('\u3000')[0].strip()) == 4
-    ]
-  
-    df = pd.DataFrame(data, columns=['股號', '股名', '產業別'])
-  
-    return df
+    return self.universe.frame(stocks_only=False)
   # 取得股票名稱
-  def get_stock_name(self, stock_id, name_df):
+  def get_stock_name(self, stock_id, name_df=None):
+    try:
+      return self.universe.name(stock_id)
+    except KeyError:
+      if name_df is None:
+        raise
       return name_df.set_index('股號').loc[stock_id, '股名']
 
+# 新聞內文快取, 以 newsId 為鍵; 新聞發布後內容不會變動, 因此永久保存
+class NewsStore():
+  def __init__(self, path='/content/drive/MyDrive/StockGPT/cache/news.db'):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS 新聞 (newsId INTEGER PRIMARY KEY, 內文 TEXT)')
+    self.conn.commit()
+    self.memory = {}
+    self.lock = threading.Lock()
+  # 取出已快取的內文, 傳回 {newsId: 內文}
+  def get_many(self, news_ids):
+    found = {i: self.memory[i] for i in news_ids if i in self.memory}
+    missing = [i for i in news_ids if i not in found]
+    if missing:
+      with self.lock:
+        rows = self.conn.execute(f"SELECT newsId, 內文 FROM 新聞 WHERE newsId IN ({','.join('?' * len(missing))})",
+                                 missing).fetchall()
+      for news_id, body in rows:
+        self.memory[news_id] = found[news_id] = body
+    return found
+  # 寫入內文, bodies 為 {newsId: 內文}
+  def put_many(self, bodies):
+    self.memory.update(bodies)
+    with self.lock, self.conn:
+      self.conn.executemany("INSERT OR REPLACE INTO 新聞 VALUES (?, ?)", bodies.items())
+
 class StockAnalysis():
-  def __init__(self,openai_api_key):
+  # db: 選用的 StockDB, 有提供時個股股價改由本機資料庫讀取
+  # news_workers: 同時下載新聞內文的執行緒數
+  # base_url: OpenAI 相容服務的網址(例如本機的模擬伺服器), 預設為 OpenAI
+  # llm_cache: LLM 回應快取, 預設為 LLMCache(); 設為 self.llm_cache = None 可停用
+  # prompt_builder: 組成資料訊息的 PromptBuilder, 可調整新聞的 tokens 預算及小數位數
+  # news_store: 新聞內文快取, 預設為 NewsStore()
+  def __init__(self,openai_api_key, http=None, db=None, news_workers=6, base_url=None, llm_cache=None,
+               prompt_builder=None, news_store=None):
     # 初始化 OpenAI API 金鑰
-    self.client = OpenAI(api_key=openai_api_key)
-    self.stock_info = StockInfo()  # 實例化 StockInfo 類別
+    self.client = OpenAI(api_key=openai_api_key, base_url=base_url)
+    self.model = "gpt-3.5-turbo"
+    self.llm_cache = llm_cache or LLMCache()
+    self.http = http or HttpCache()  # 共用的 HTTP 快取
+    self.stock_info = StockInfo(self.http)  # 實例化 StockInfo 類別
     self.name_df = self.stock_info.stock_name()
+    self.db = db
+    self.gap_checked = set()  # 已檢查過尾端缺漏的 (股號, 日期)
+    self.news_store = news_store or NewsStore()  # 新聞內文快取
+    self.news_workers = news_workers
+    self.prompt_builder = prompt_builder or PromptBuilder(self.model)
+    self.prompt_reports = {}  # 各股號最近一次訊息的各段 tokens 數
+    self.last_prompt_report = None
   # 從 yfinance 取得一周股價資料
   def stock_price(self, stock_id="大盤", days = 15):
+    if self.db is not None and stock_id != "大盤":
+      return self.stock_price_db(stock_id, days)
     if stock_id == "大盤":
       stock_id="^TWII"
     else:
@@ -47,7 +97,8 @@ class StockAnalysis():
     end = dt.date.today() # 資料結束時間
     start = end - dt.timedelta(days=days) # 資料開始時間
     # 下載資料
-    df = yf.download(stock_id, start=start, auto_adjust=False, multi_level_index=False)
+    with yf_lock:
+      df = yf.download(stock_id, start=start, auto_adjust=False, multi_level_index=False)
   
     # 更換列名
     df.columns = ['調整後收盤價', '收盤價', '最高價',
@@ -61,10 +112,58 @@ class StockAnalysis():
       }
   
     return data
+  # 從 StockDB 的日頻資料表讀取股價(一次索引範圍查詢), 只有尾端缺少的交易日才連網補齊並寫回
+  def stock_price_db(self, stock_id, days=15):
+    end = dt.date.today()
+    start = end - dt.timedelta(days=days)
+    df = self.db.get('日頻', ['日期', '收盤價'], stocks=stock_id, start=start.isoformat())
+    last = df['日期'].max() if len(df) else None
+    expected = self.last_trading_day()
+    if (last is None or last < expected) and (stock_id, expected) not in self.gap_checked:
+      self.gap_checked.add((stock_id, expected))
+      gap_start = start if last is None else dt.date.fromisoformat(last) + dt.timedelta(days=1)
+      gap_df = self.download_price(stock_id, gap_start)
+      if len(gap_df):
+        self.db.upsert('日頻', gap_df)
+        df = pd.concat([df, gap_df[['日期', '收盤價']]], ignore_index=True)
+    df = df.sort_values('日期', ignore_index=True)
+
+    data = {
+      '日期': df['日期'].tolist(),
+      '收盤價': df['收盤價'].tolist(),
+      '每日報酬': df['收盤價'].pct_change().tolist(),
+      }
+    return data
+
+  # 最近一個應有收盤資料的交易日(只排除週末; 台股 13:30 收盤, 14:00 後才算當天)
+  def last_trading_day(self):
+    now = dt.datetime.now()
+    day = now.date() if now.hour >= 14 else now.date() - dt.timedelta(days=1)
+    while day.weekday() >= 5:
+      day -= dt.timedelta(days=1)
+    return day.isoformat()
+
+  # 從 yfinance 下載個股股價, 轉為日頻資料表的欄位
+  def download_price(self, stock_id, start):
+    with yf_lock:
+      df = yf.download(stock_id + ".TW", start=start, auto_adjust=False, multi_level_index=False)
+    if len(df) == 0:
+      return pd.DataFrame(columns=['股號', '日期', '收盤價'])
+    df = df.rename(columns={'Open': '開盤價', 'High': '最高價', 'Low': '最低價',
+                            'Close': '收盤價', 'Adj Close': '還原價', 'Volume': '成交量'})
+    df = df[['開盤價', '最高價', '最低價', '收盤價', '還原價', '成交量']]
+    df.insert(0, '日期', df.index.strftime('%Y-%m-%d'))
+    df.insert(0, '股號', stock_id)
+    return df.reset_index(drop=True)
   # 基本面資料
   def stock_fundamental(self, stock_id= "大盤"):
     if stock_id == "大盤":
         return None
+
+    if self.db is not None: # 由 StockDB 預先計算的基本面表查詢
+      data = self.stock_fundamental_db(stock_id)
+      if data is not None:
+        return data
   
     stock_id += ".TW"
     stock = yf.Ticker(stock_id)
@@ -89,49 +188,121 @@ class StockAnalysis():
     }
   
     return data
+  # 從 StockDB 的基本面表取出最近幾季(新到舊), 格式與 stock_fundamental 相同
+  def stock_fundamental_db(self, stock_id, quarters=4):
+    df = self.db.get('基本面', stocks=stock_id)
+    if df.empty:
+      return None
+    df = df.sort_values('季末日', ascending=False).head(quarters)
+    growth = df.dropna(subset=['營收成長率'])
+    return {
+        '季日期': growth['季末日'].tolist(),
+        '營收成長率': growth['營收成長率'].tolist(),
+        'EPS': df['EPS'].dropna().tolist(),
+        'EPS 季增率': df['EPS季增率'].dropna().tolist()
+    }
   # 新聞資料
   def stock_news(self, stock_name ="大盤"):
-    if stock_name == "大盤":
-      stock_name="台股 -盤中速報"
-  
-    data=[]
-    # 取得 Json 格式資料
-    json_data = requests.get(f'https://ess.api.cnyes.com/ess/api/v1/news/keyword?q={stock_name}&limit=6&page=1').json()
-  
-    # 依照格式擷取資料
-    items=json_data['data']['items']
-    for item in items:
+    return self.stock_news_many([stock_name])[stock_name]
+
+  # 一次取得多檔股票(可含 "大盤")的新聞, 傳回 {名稱: 新聞串列}
+  # 各個股的新聞都完整保留, 只有大盤的新聞會排除已出現在任一個股的新聞
+  # 內文以執行緒池同時下載, 並依 newsId 快取
+  def stock_news_many(self, stock_names):
+    names = list(dict.fromkeys(stock_names))
+    with ThreadPoolExecutor(self.news_workers) as pool:
+      item_lists = list(pool.map(self.news_items, names))
+    bodies = self.news_bodies([item["newsId"] for items in item_lists for item in items])
+    stock_news_ids = {item["newsId"] for name, items in zip(names, item_lists)
+                      if name != "大盤" for item in items}
+
+    result = {}
+    for name, items in zip(names, item_lists):
+      keyword = "台股 -盤中速報" if name == "大盤" else name
+      data = []
+      seen = set() # 同一份列表中重複的新聞
+      for item in items:
         # 網址、標題和日期
         news_id = item["newsId"]
-        title = item["title"]
-        publish_at = item["publishAt"]
+        if news_id in seen or news_id not in bodies:
+          continue
+        if name == "大盤" and news_id in stock_news_ids:
+          continue
+        seen.add(news_id)
         # 使用 UTC 時間格式
-        utc_time = dt.datetime.utcfromtimestamp(publish_at)
+        utc_time = dt.datetime.utcfromtimestamp(item["publishAt"])
         formatted_date = utc_time.strftime('%Y-%m-%d')
-        # 前往網址擷取內容
-        url = requests.get(f'https://news.cnyes.com/'
-                          f'news/id/{news_id}').content
-        soup = BeautifulSoup(url, 'html.parser')
-        p_elements=soup .find_all('p')
-        # 提取段落内容
-        p=''
-        for paragraph in p_elements[4:]:
-            p+=paragraph.get_text()
-        data.append([stock_name, formatted_date ,title,p])
-    return data
-    
+        data.append([keyword, formatted_date, item["title"], bodies[news_id]])
+      result[name] = data
+    return result
+
+  # 以關鍵字查詢新聞列表, 查詢失敗時傳回空串列(批次報告中不影響其他股票)
+  def news_items(self, stock_name):
+    if stock_name == "大盤":
+      stock_name="台股 -盤中速報"
+    try:
+      # 取得 Json 格式資料
+      json_data = self.http.get(f'https://ess.api.cnyes.com/ess/api/v1/news/keyword?q={stock_name}&limit=6&page=1').json()
+      return json_data['data']['items']
+    except Exception as e:
+      print(f"{stock_name} 新聞查詢失敗：{e}")
+      return []
+
+  # 取得多則新聞的內文, 未快取的以執行緒池同時下載, 傳回 {newsId: 內文}
+  def news_bodies(self, news_ids):
+    news_ids = list(dict.fromkeys(news_ids))
+    bodies = self.news_store.get_many(news_ids)
+    missing = [i for i in news_ids if i not in bodies]
+    if missing:
+      fetched = {}
+      with ThreadPoolExecutor(self.news_workers) as pool:
+        for news_id, body in zip(missing, pool.map(self.news_body, missing)):
+          if body is not None:
+            fetched[news_id] = body
+      self.news_store.put_many(fetched)
+      bodies.update(fetched)
+    return bodies
+
+  # 下載並擷取單則新聞的內文, 只解析 <p> 標籤(不建立整份文件的樹狀結構)
+  # 內文已存於 NewsStore, 網頁不再經過 HttpCache, 以免同一則新聞存兩份
+  def news_body(self, news_id):
+    try:
+      html = get_with_retry(f'https://news.cnyes.com/news/id/{news_id}').content
+    except Exception as e:
+      print(f"新聞 {news_id} 下載失敗：{e}")
+      return None
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('p'))
+    p_elements = soup.find_all('p')
+    # 提取段落内容
+    return ''.join(paragraph.get_text() for paragraph in p_elements[4:])
+
   # 建立 GPT 3.5-16k 模型
+  # 相同的模型及訊息會直接使用快取的回應(錯誤訊息不快取)
   def get_reply(self, messages):
+    key = self.reply_key(messages)
+    if key is not None:
+      reply = self.llm_cache.get(key)
+      if reply is not None:
+        return reply
     try:
+      start = time.perf_counter()
       response = self.client.chat.completions.create(
-          model="gpt-3.5-turbo",
+          model=self.model,
           temperature=0,
           messages=messages
       )
       reply = response.choices[0].message.content
+      if key is not None:
+        self.llm_cache.put(key, self.model, reply, time.perf_counter() - start)
     except openai.OpenAIError as err:
       reply = f"發生 {err.type} 錯誤\n{err.message}"
     return reply
+
+  # LLM 快取的鍵, 未啟用快取時傳回 None
+  def reply_key(self, messages):
+    if self.llm_cache is None:
+      return None
+    return self.llm_cache.key(self.model, messages, temperature=0)
   
     # 設定 AI 角色, 使其依據使用者需求進行 df 處理
   def ai_helper(self,user_msg):
@@ -223,26 +394,30 @@ class StockAnalysis():
   
       price_data = self.stock_price(stock_id)
       news_data = self.stock_news(stock_name)
-  
-      content_msg = f'你現在是一位專業的證券分析師, '\
-        '你會依據以下資料來進行分析並給出一份完整的分析報告:\n'
-  
-      content_msg += f'近期價格資訊:\n {price_data}\n'
-  
+      stock_value_data = self.stock_fundamental(stock_id) if stock_id != "大盤" else None
+      return self.build_content_msg(stock_id, stock_name, price_data, stock_value_data, news_data)
+
+  # 以取得的資料組成訊息指令
+  # 數值以四捨五入的表格呈現, 新聞內文依 tokens 預算截斷; 各段 tokens 數記錄於 prompt_reports
+  def build_content_msg(self, stock_id, stock_name, price_data, stock_value_data, news_data):
+      builder = self.prompt_builder
+      sections = [('開頭', '', '你現在是一位專業的證券分析師, '
+                   '你會依據以下資料來進行分析並給出一份完整的分析報告:'),
+                  ('價格', '近期價格資訊:', builder.table(price_data))]
       if stock_id != "大盤":
-          stock_value_data = self.stock_fundamental(stock_id)
-          content_msg += f'每季營收資訊：\n {stock_value_data}\n'
-  
-      content_msg += f'近期新聞資訊: \n {news_data}\n'
-      content_msg += f'請給我{stock_name}近期的趨勢報告,請以詳細、'\
+          sections.append(('基本面', '每季營收資訊：', builder.table(stock_value_data)))
+      sections.append(('新聞', '近期新聞資訊:', builder.news(news_data)))
+      closing = f'請給我{stock_name}近期的趨勢報告,請以詳細、'\
         '嚴謹及專業的角度撰寫此報告,並提及重要的數字, reply in 繁體中文'
-  
+
+      content_msg, report = builder.build(sections, closing)
+      self.prompt_reports[stock_id] = report
+      self.last_prompt_report = report
       return content_msg
 
-  # StockGPT
-  def stock_gpt(self, stock_id):
-      content_msg = self.generate_content_msg(stock_id, self.name_df)
-      msg = [{
+  # StockGPT 的訊息(系統角色 + 資料)
+  def gpt_messages(self, content_msg):
+      return [{
           "role": "system",
           "content": f"你現在是一位專業的證券分析師, 你會統整近期的股價漲幅"\
         "、基本面、新聞資訊等方面並進行分析, 然後生成一份專業的趨勢分析報告, tokens數量上限為1600"
@@ -250,7 +425,107 @@ class StockAnalysis():
           "role": "user",
           "content": content_msg
       }]
+
+  # StockGPT
+  def stock_gpt(self, stock_id):
+      content_msg = self.generate_content_msg(stock_id, self.name_df)
+      msg = self.gpt_messages(content_msg)
   
       reply_data = self.get_reply(msg)
       
       return reply_data
+
+  # 非同步呼叫 LLM：以 semaphore 限制同時請求數, 遇到速率限制(429)時依 Retry-After 等待,
+  # 連線錯誤、逾時及伺服器錯誤則以指數退避重試
+  async def aget_reply(self, aclient, messages, semaphore, retries=5, backoff=1):
+    key = self.reply_key(messages)
+    if key is not None:
+      reply = self.llm_cache.get(key)
+      if reply is not None:
+        return reply
+    for attempt in range(retries + 1):
+      try:
+        async with semaphore:
+          start = time.perf_counter()
+          response = await aclient.chat.completions.create(
+              model=self.model,
+              temperature=0,
+              messages=messages
+          )
+        reply = response.choices[0].message.content
+        if key is not None:
+          self.llm_cache.put(key, self.model, reply, time.perf_counter() - start)
+        return reply
+      except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as err:
+        if attempt == retries:
+          return f"發生 {type(err).__name__} 錯誤\n{err}"
+        wait = backoff * 2 ** attempt + random.uniform(0, 1)
+        response = getattr(err, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+          try:
+            wait = max(wait, float(retry_after))
+          except ValueError:
+            pass
+        await asyncio.sleep(wait)
+      except openai.OpenAIError as err:
+        return f"發生 {type(err).__name__} 錯誤\n{err}"
+
+  # 批次產生多檔股票的報告(非同步產生器), 完成一檔就傳回一檔 (股號, 報告)
+  # 股價、基本面及新聞以執行緒同時取得(新聞一次查詢全部, 內文不重複下載),
+  # LLM 呼叫最多 concurrency 個同時進行
+  # 用法：async for stock_id, report in analysis.astock_gpt_many(['2330', '2317']): ...
+  async def astock_gpt_many(self, stock_ids, concurrency=8, data_workers=8):
+    aclient = AsyncOpenAI(api_key=self.client.api_key, base_url=self.client.base_url, max_retries=0)
+    llm_semaphore = asyncio.Semaphore(concurrency)
+    data_semaphore = asyncio.Semaphore(data_workers)
+    def name_of(stock_id):
+      return stock_id if stock_id == "大盤" else self.stock_info.get_stock_name(stock_id, self.name_df)
+    names = {} # 查得到股名的股號; 查不到的在 one() 中再查一次並回報錯誤, 不影響其他股票
+    for stock_id in dict.fromkeys(stock_ids):
+      try:
+        names[stock_id] = name_of(stock_id)
+      except Exception:
+        pass
+    news_task = asyncio.create_task(asyncio.to_thread(self.stock_news_many, list(names.values())))
+
+    async def run_blocking(func, *args):
+      async with data_semaphore:
+        return await asyncio.to_thread(func, *args)
+
+    async def one(stock_id):
+      try:
+        name = names[stock_id] if stock_id in names else name_of(stock_id)
+        price_data, stock_value_data = await asyncio.gather(
+            run_blocking(self.stock_price, stock_id),
+            run_blocking(self.stock_fundamental, stock_id))
+        news_data = (await news_task)[name]
+        content_msg = self.build_content_msg(stock_id, name, price_data,
+                                             stock_value_data, news_data)
+        reply = await self.aget_reply(aclient, self.gpt_messages(content_msg), llm_semaphore)
+      except Exception as e:
+        reply = f"發生錯誤：{e}"
+      return stock_id, reply
+
+    try:
+      for task in asyncio.as_completed([one(stock_id) for stock_id in dict.fromkeys(stock_ids)]):
+        yield await task
+    finally:
+      await aclient.close()
+
+  # 同步版本的批次報告, 傳回 {股號: 報告}; callback(股號, 報告) 會在每檔完成時呼叫
+  # 在已有事件迴圈的環境(如 Colab/Jupyter)中會改在另一個執行緒執行
+  def stock_gpt_many(self, stock_ids, callback=None, **kwargs):
+    async def collect():
+      reports = {}
+      async for stock_id, report in self.astock_gpt_many(stock_ids, **kwargs):
+        reports[stock_id] = report
+        if callback:
+          callback(stock_id, report)
+      return reports
+    try:
+      asyncio.get_running_loop()
+    except RuntimeError:
+      return asyncio.run(collect())
+    with ThreadPoolExecutor(1) as pool:
+      return pool.submit(asyncio.run, collect()).result()
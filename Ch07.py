@@ -1,20 +1,50 @@
 import os
+import re
 import time
-import random
+import json
+import hashlib
+import tempfile
+import threading
 import zipfile
-import io
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from bs4 import BeautifulSoup
-from langchain_community.document_loaders import PDFPlumberLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.documents import Document
 from langchain.chains.summarize import load_summarize_chain
-from langchain_community.vectorstores import FAISS
+from llm_cache import LLMCache
+from http_util import RateLimiter
+from embedding_cache import CachedEmbeddings, build_index
+from vector_store import VectorStoreManager, search
+from pdf_text import PdfTextExtractor, file_hash
 
 class PdfLoader:
-    def __init__(self, openai_api_key):
+    DOC_URL = 'https://doc.twse.com.tw' # 公開資訊觀測站電子書網址, 可改為本機的測試伺服器
+    PDF_DIR = '/content/drive/MyDrive/StockGPT/PDF/'
+    DB_DIR = '/content/drive/MyDrive/StockGPT/DB/'
+    CHUNK_SIZE = 1 << 16 # 串流下載每次寫入的位元組數
+    REPORT_RE = re.compile(r'^(\d+)_(\w+)\.pdf$') # 年報檔名：{年度}_{股號}.pdf
+
+    # llm_cache: 摘要結果的快取, 預設為 LLMCache(); 設為 self.llm_cache = None 可停用
+    # rate: 年報下載每秒的請求數(所有執行緒共用)
+    # extractor: PDF 文字擷取器, 預設為多行程擷取並依檔案雜湊快取每頁文字的 PdfTextExtractor()
+    # embeddings: 向量模型, 預設為 OpenAIEmbeddings; 不是 CachedEmbeddings 時會自動包裝
+    #             (測試時可直接傳入 DeterministicFakeEmbedding(size=...))
+    # max_indexes: 記憶體中最多保留的向量索引數
+    def __init__(self, openai_api_key, llm_cache=None, rate=0.5, extractor=None, embeddings=None,
+                 max_indexes=4):
         os.environ['OPENAI_API_KEY'] = openai_api_key
+        self.llm_cache = llm_cache or LLMCache()
+        self.limiter = RateLimiter(rate, burst=2)
+        self._manifest = None
+        self.manifest_lock = threading.Lock()
+        self.extractor = extractor or PdfTextExtractor()
+        if not isinstance(embeddings, CachedEmbeddings):
+            embeddings = CachedEmbeddings(embeddings or OpenAIEmbeddings())
+        self.embeddings = embeddings
+        self.stores = VectorStoreManager(self.embeddings, self.DB_DIR, max_indexes)
         
         self.llm = ChatOpenAI(temperature=0, model="gpt-4-turbo")
         self.data_prompt = ChatPromptTemplate.from_messages(messages=[("system","你的任務是對年報資訊進行摘要總結。"
@@ -23,16 +53,39 @@ class PdfLoader:
                     "最後請使用繁體中文輸出報告")])
         self.data_chain = load_summarize_chain(llm=self.llm, chain_type='stuff', prompt=self.data_prompt)
 
+    # 下載單一公司某年度的年報, 傳回 PDF 路徑(找不到或失敗時為 None)
     def annual_report(self, id, y):
-        wait_time = random.uniform(2, 6)
-        url = 'https://doc.twse.com.tw/server-java/t57sb01'
-        folder_path = '/content/drive/MyDrive/StockGPT/PDF/'
-        
-        # 確保目錄存在
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-            
-        # 建立 POST 請求的表單
+        return self.annual_reports([(id, y)], workers=1)[(id, y)]
+
+    # 批次下載年報, pairs 為 [(股號, 年度)], 傳回 {(股號, 年度): PDF 路徑或 None}
+    # 各執行緒共用同一個限速器(證交所網站有流量限制); 內容以串流分段寫入磁碟, 不會整份讀入記憶體
+    # 已下載且大小(verify=True 時也比對 SHA-256)與 manifest 相符的檔案會略過, 中斷後重新執行只下載缺少的
+    def annual_reports(self, pairs, workers=3, verify=False):
+        os.makedirs(self.PDF_DIR, exist_ok=True)
+        results = {}
+        with ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(self.download_report, id, y, verify): (id, y) for id, y in pairs}
+            for future in as_completed(futures):
+                id, y = futures[future]
+                try:
+                    results[(id, y)] = future.result()
+                except Exception as e:
+                    print(f"{y}_{id} 下載失敗: {e}")
+                    results[(id, y)] = None
+        done = sum(path is not None for path in results.values())
+        print(f"年報下載完成: {done}/{len(results)} 份")
+        return results
+
+    def report_path(self, id, y):
+        return os.path.join(self.PDF_DIR, f"{y}_{id}.pdf")
+
+    def download_report(self, id, y, verify=False):
+        path = self.report_path(id, y)
+        if self.report_valid(path, verify):
+            print(f"{y}_{id}.pdf 已存在，略過")
+            return path
+
+        # 建立 POST 請求的表單, 取得檔案名稱
         data = {
             "id": "",
             "key": "",
@@ -43,112 +96,255 @@ class PdfLoader:
             "mtype": 'F',
             "dtype": 'F04'
         }
-        
-        # 發送 POST 請求
-        with requests.post(url, data=data) as response:
-            time.sleep(wait_time)
-            # 取得回應後擷取檔案名稱
-            link = BeautifulSoup(response.text, 'html.parser')
-            try:
-                link1 = link.find('a').text
-                print(link1)
-            except AttributeError:
-                print("找不到連結，請確認ID和年份是否正確")
-                return
-    
+        url = self.DOC_URL + '/server-java/t57sb01'
+        link = BeautifulSoup(self.post(url, data).text, 'html.parser').find('a')
+        if link is None:
+            print(f"{y}_{id} 找不到連結，請確認ID和年份是否正確")
+            return None
+        filename = link.text
+        print(filename)
+
         # 建立第二個 POST 請求的表單
         data2 = {
             'step': '9',
             'kind': 'F',
             'co_id': id,
-            'filename': link1  # 檔案名稱
+            'filename': filename  # 檔案名稱
         }
-        
-        # 檢查文件類型
-        file_extension = link1.split('.')[-1]
-        if file_extension == 'zip':
-            try:
-                with requests.post(url, data=data2) as response2:
-                    if response2.status_code == 200:
-                        zip_data = io.BytesIO(response2.content)
-                        with zipfile.ZipFile(zip_data) as myzip:
-                            # 瀏覽 ZIP 檔案中的所有檔案和資料夾
-                            pdf_found = False
-                            for file_info in myzip.namelist():
-                                if file_info.endswith('.pdf'):
-                                    pdf_found = True
-                                    # 讀取 PDF 檔案
-                                    with myzip.open(file_info) as myfile:
-                                        # 你可以選擇如何處理 PDF 檔案，例如儲存它
-                                        with open(folder_path + y + '_' + id + '.pdf', 'wb') as f:
-                                            f.write(myfile.read())
-                                        print('PDF文件儲存成功')
-                            if not pdf_found:
-                                print("ZIP檔中未找到PDF文件")
-            except Exception as e:
-                print(f"處理ZIP檔案時發生錯誤: {e}")
+        if filename.split('.')[-1] == 'zip':
+            # ZIP 先串流存成暫存檔, 再從中分段複製出 PDF
+            with self.post(url, data2, stream=True) as response, \
+                    tempfile.TemporaryFile(dir=self.PDF_DIR) as zip_file:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    zip_file.write(chunk)
+                with zipfile.ZipFile(zip_file) as myzip:
+                    names = [name for name in myzip.namelist() if name.endswith('.pdf')]
+                    if not names:
+                        print(f"{y}_{id} ZIP檔中未找到PDF文件")
+                        return None
+                    with myzip.open(names[0]) as myfile:
+                        size, digest = self.save_stream(iter(lambda: myfile.read(self.CHUNK_SIZE), b''), path)
         else:
-            try:
-                # 發送 POST 請求
-                with requests.post(url, data=data2) as response2:
-                    time.sleep(wait_time)
-                    link = BeautifulSoup(response2.text, 'html.parser')
-                    try:
-                        link1 = link.find('a')['href']
-                        print(link1)
-                    except (AttributeError, TypeError):
-                        print("找不到下載連結，請確認回應格式")
-                        return
-            
-                # 發送 GET 請求
-                full_url = 'https://doc.twse.com.tw' + link1
-                response3 = requests.get(full_url)
-                time.sleep(wait_time)
-                
-                # 檢查回應狀態
-                if response3.status_code == 200:
-                    with open(folder_path + y + '_' + id + '.pdf', 'wb') as file:
-                        file.write(response3.content)
-                    print('PDF文件儲存成功')
-                else:
-                    print(f"下載PDF失敗，狀態碼: {response3.status_code}")
-            except Exception as e:
-                print(f"下載PDF文件時發生錯誤: {e}")
-            
+            link = BeautifulSoup(self.post(url, data2).text, 'html.parser').find('a')
+            if link is None or not link.get('href'):
+                print(f"{y}_{id} 找不到下載連結，請確認回應格式")
+                return None
+            self.limiter.acquire()
+            with requests.get(self.DOC_URL + link['href'], stream=True, timeout=60) as response:
+                response.raise_for_status()
+                size, digest = self.save_stream(response.iter_content(self.CHUNK_SIZE), path)
+
+        self.record(path, size, digest)
+        print(f'{y}_{id}.pdf 儲存成功')
+        return path
+
+    # 受限速的 POST 請求
+    def post(self, url, data, stream=False):
+        self.limiter.acquire()
+        response = requests.post(url, data=data, stream=stream, timeout=60)
+        response.raise_for_status()
+        return response
+
+    # 將分段資料寫入暫存檔並計算 SHA-256, 完成後才改名, 避免留下不完整的檔案
+    def save_stream(self, chunks, path):
+        digest = hashlib.sha256()
+        size = 0
+        tmp = f"{path}.{threading.get_ident()}.part"
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        os.replace(tmp, path)
+        return size, digest.hexdigest()
+
+    # 檔案是否已完整下載; 舊版下載(不在 manifest 中)的 PDF 檢查檔頭後補記錄
+    def report_valid(self, path, verify=False):
+        if not os.path.exists(path):
+            return False
+        name = os.path.basename(path)
+        with self.manifest_lock:
+            entry = self.manifest().get(name)
+        if entry is None:
+            with open(path, 'rb') as f:
+                if f.read(5) != b'%PDF-':
+                    return False
+            self.record(path, os.path.getsize(path), file_hash(path))
+            return True
+        if os.path.getsize(path) != entry['size']:
+            return False
+        return not verify or file_hash(path) == entry['sha256']
+
+    # 各 PDF 的大小及 SHA-256, 存於 PDF 目錄的 manifest.json
+    def manifest(self):
+        if self._manifest is None:
+            path = os.path.join(self.PDF_DIR, 'manifest.json')
+            self._manifest = {}
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+        return self._manifest
+
+    def record(self, path, size, digest):
+        with self.manifest_lock:
+            self.manifest()[os.path.basename(path)] = {'size': size, 'sha256': digest}
+            manifest_path = os.path.join(self.PDF_DIR, 'manifest.json')
+            with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self._manifest, f, ensure_ascii=False, indent=1)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+    # 取得 PDF 的向量索引; 已儲存且來源檔、切塊參數及模型都相同時直接載入, 否則才重建
     def pdf_loader(self, file, size, overlap):
         try:
-            loader = PDFPlumberLoader(file)
-            doc = loader.load()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=size,
-                                                   chunk_overlap=overlap)
-            new_doc = text_splitter.split_documents(doc)
-            
-            # 使用FAISS
-            db = FAISS.from_documents(new_doc, OpenAIEmbeddings())
             file_name = file.split("/")[-1].split(".")[0]
-            db_file = '/content/drive/MyDrive/StockGPT/DB/'
-            if not os.path.exists(db_file):
-                os.makedirs(db_file)
-                
+            signature = {'來源': file_hash(file), '切塊': [size, overlap], '模型': self.embeddings.model}
+
+            def build(old):
+                new_doc = self.report_chunks(file, size, overlap)
+                # 使用FAISS, 已計算過的區塊向量直接從快取取得, 有舊索引時只更新差異
+                return build_index(new_doc, self.embeddings, old)
+
             # 保存FAISS向量數據庫
-            db.save_local(db_file + file_name)
-            return db
+            return self.stores.get(file_name, signature, build)
         except Exception as e:
             print(f"處理PDF文件時發生錯誤: {e}")
             return None
         
-    def analyze_chain(self, db, input):
+    # 切塊並加上 公司、年度(民國年) 的 metadata, 頁碼在 page(從 0 起算)
+    def report_chunks(self, file, size, overlap):
+        doc = self.extractor.load(file)
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=size,
+                                               chunk_overlap=overlap)
+        chunks = text_splitter.split_documents(doc)
+        match = self.REPORT_RE.match(os.path.basename(file))
+        if match:
+            for chunk in chunks:
+                chunk.metadata['年度'] = int(match.group(1))
+                chunk.metadata['公司'] = match.group(2)
+        return chunks
+
+    # 所有已下載年報(PDF_DIR 中的 {年度}_{股號}.pdf)的合併索引, 可用 analyze_chain 的 companies/years 篩選
+    # 新增或更新年報時, 只有變動的年報需要切塊及計算向量
+    def corpus_index(self, size=1000, overlap=100):
+        try:
+            files = sorted(f for f in os.listdir(self.PDF_DIR) if self.REPORT_RE.match(f))
+            with self.manifest_lock:
+                manifest = dict(self.manifest())
+            sources = {}
+            for f in files: # 下載時已記錄雜湊值的檔案不必重新計算
+                path = os.path.join(self.PDF_DIR, f)
+                entry = manifest.get(f)
+                if entry and entry['size'] == os.path.getsize(path):
+                    sources[f] = entry['sha256']
+                else:
+                    sources[f] = file_hash(path)
+            signature = {'來源': sources, '切塊': [size, overlap], '模型': self.embeddings.model}
+
+            def build(old):
+                docs = [chunk for f in files
+                        for chunk in self.report_chunks(os.path.join(self.PDF_DIR, f), size, overlap)]
+                return build_index(docs, self.embeddings, old)
+
+            return self.stores.get('corpus', signature, build)
+        except Exception as e:
+            print(f"建立合併索引時發生錯誤: {e}")
+            return None
+
+    # 依公司及年度篩選的條件; years 可為單一年度或 (起, 迄), None 表示不限
+    @staticmethod
+    def report_filter(companies=None, years=None):
+        if companies is None and years is None:
+            return None
+        if isinstance(companies, str):
+            companies = [companies]
+        companies = None if companies is None else {str(c) for c in companies}
+        if isinstance(years, int):
+            years = (years, years)
+        start, end = years if years is not None else (None, None)
+
+        def match(metadata):
+            if companies is not None and metadata.get('公司') not in companies:
+                return False
+            year = metadata.get('年度')
+            if start is not None and (year is None or year < start):
+                return False
+            if end is not None and (year is None or year > end):
+                return False
+            return True
+        return match
+
+    # companies: 股號清單, years: 年度或 (起, 迄), 用於合併索引的篩選; k: 取出的區塊數
+    def analyze_chain(self, db, input, companies=None, years=None, k=2):
         try:
             if db is None:
                 return "無法分析：向量數據庫為空"
-                
-            data = db.similarity_search(input, k=2)
-            
+
+            filter = self.report_filter(companies, years)
+            if filter is None:
+                data = db.similarity_search(input, k=k)
+            else:
+                vector = self.embeddings.embed_query(input)
+                data = [doc for doc, _ in search(db, [vector], k, filter)[0]]
+
             if not data:
                 return "無法找到相關資訊"
                 
-            result = self.data_chain.invoke({"input_documents": data})
-            return result['output_text']
+            return self.summarize(self.label(data))
         except Exception as e:
             print(f"分析過程中發生錯誤: {e}")
             return f"分析失敗: {str(e)}"
+
+    # 批次回答多個問題：一次計算全部問題的向量並以一次向量化搜尋取回區塊,
+    # 摘要鏈最多 workers 個同時執行; 傳回 [{問題, 回答, 檢索秒數, 生成秒數}]
+    # 檢索秒數為整批嵌入及搜尋時間的平均, 整批的時間記錄於 last_batch_stats
+    def analyze_batch(self, db, questions, companies=None, years=None, k=2, workers=4):
+        if db is None:
+            return [{'問題': q, '回答': "無法分析：向量數據庫為空", '檢索秒數': 0, '生成秒數': 0}
+                    for q in questions]
+        started = time.perf_counter()
+        vectors = self.embeddings.embed_matrix(questions, 'query')
+        embedded = time.perf_counter()
+        hits = search(db, vectors, k, self.report_filter(companies, years))
+        searched = time.perf_counter()
+        retrieval = (searched - started) / max(len(questions), 1)
+
+        def answer(docs):
+            generate_started = time.perf_counter()
+            if not docs:
+                reply = "無法找到相關資訊"
+            else:
+                try:
+                    reply = self.summarize(self.label([doc for doc, _ in docs]))
+                except Exception as e:
+                    reply = f"分析失敗: {str(e)}"
+            return reply, time.perf_counter() - generate_started
+
+        with ThreadPoolExecutor(workers) as pool:
+            replies = list(pool.map(answer, hits))
+        self.last_batch_stats = {'問題數': len(questions), '嵌入秒數': round(embedded - started, 3),
+                                 '搜尋秒數': round(searched - embedded, 3),
+                                 '總秒數': round(time.perf_counter() - started, 3)}
+        print(f"批次分析 {len(questions)} 題：嵌入 {self.last_batch_stats['嵌入秒數']} 秒, "
+              f"搜尋 {self.last_batch_stats['搜尋秒數']} 秒, 共 {self.last_batch_stats['總秒數']} 秒")
+        return [{'問題': q, '回答': reply, '檢索秒數': round(retrieval, 3), '生成秒數': round(seconds, 3)}
+                for q, (reply, seconds) in zip(questions, replies)]
+
+    # 區塊來自多份年報時, 在內文前標示公司、年度及頁碼
+    @staticmethod
+    def label(docs):
+        if len({doc.metadata.get('source') for doc in docs}) <= 1:
+            return docs
+        return [Document(page_content=f"[{doc.metadata.get('公司')} {doc.metadata.get('年度')} 年報 "
+                                      f"第 {doc.metadata.get('page', 0) + 1} 頁]\n{doc.page_content}",
+                         metadata=doc.metadata) for doc in docs]
+
+    # 執行摘要鏈; 相同的模型、提示及文件內容會直接使用快取的結果
+    def summarize(self, docs):
+        def invoke():
+            return self.data_chain.invoke({"input_documents": docs})['output_text']
+        if self.llm_cache is None:
+            return invoke()
+        key = self.llm_cache.key(self.llm.model_name,
+                                 [self.data_prompt.pretty_repr(), [doc.page_content for doc in docs]],
+                                 temperature=0)
+        return self.llm_cache.cached(key, self.llm.model_name, invoke)
@@ -1,22 +1,58 @@
 import sqlite3
-import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 import yfinance as yf
-import os, time
+import os, time, shutil, threading
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from http_util import RateLimiter, HttpCache, get_with_retry
+from universe import TickerUniverse
+try: # 欄式鏡像(columnar)需要 pyarrow
+  import pyarrow as pa
+  import pyarrow.dataset as ds
+  import pyarrow.parquet as pq
+  from pyarrow import fs as pafs
+except ImportError:
+  pa = None
 
 
 class StockDB:
-  def __init__(self, db_path='/content/drive/MyDrive/StockGPT/stock.db', db_start_date='2015-01-01'):
+  TWSE_URL = 'https://www.twse.com.tw' # 證交所網址, 可改為本機的測試伺服器
+  YAHOO_URL = 'https://tw.stock.yahoo.com' # Yahoo 股市網址
+
+  # rate: 對證交所每秒的請求數上限, workers: 同時下載的執行緒數
+  # fast_ingest: 是否開啟快速寫入模式(見 fast_ingest 方法)
+  # http: 共用的 HttpCache, 預設存放在資料庫旁的 cache/http 資料夾
+  # columnar: 是否在 renew_daily 後更新日頻的 Parquet 鏡像(需要 pyarrow),
+  #           partition_stock: 鏡像是否再依股號分割(依年份之外)
+  def __init__(self, db_path='/content/drive/MyDrive/StockGPT/stock.db', db_start_date='2015-01-01',
+               rate=0.6, workers=3, fast_ingest=False, http=None,
+               columnar=False, partition_stock=False):
     exist = os.path.exists(db_path) #是否已建立資料庫
     self.db_path = db_path
     self.db_start_date = db_start_date
-    self.conn = sqlite3.connect(db_path)
+    self.conn = sqlite3.connect(db_path, check_same_thread=False) # 允許其他執行緒(如 StockAnalysis 的批次報告)讀取
+    # 連線由多個執行緒共用, 讀寫時須持有此鎖, 各執行緒的交易才不會混在同一個隱含交易中
+    self.lock = threading.RLock()
     self.ids = None
+    self.limiter = RateLimiter(rate) # 所有執行緒共用的限速器
+    self.workers = workers
+    if http is None:
+      http = HttpCache(os.path.join(os.path.dirname(os.path.abspath(db_path)), 'cache', 'http'))
+    self.http = http
+    # 股號清單快照(與 StockInfo 共用同一個服務)
+    self.universe = TickerUniverse.shared(
+        os.path.join(os.path.dirname(os.path.abspath(db_path)), 'cache', 'universe.json'), http)
+    self.columnar = columnar
+    self.partition_stock = partition_stock
+    self.columnar_path = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'columnar', '日頻')
+    self.last_ingest = None # 最近一次 upsert 的寫入統計
+    self.company_retry = [] # renew_company 讀取失敗的股號
+    if fast_ingest:
+      self.fast_ingest()
     if not exist: #如果未建立資料庫
       print("建立資料庫：" + db_path)
-      self.create_tables() # 建立資料表
+    self.migrate() # 建立資料表, 或將舊版資料庫升級到最新結構
 
   # 建立資料表(不存在時才會建立)
   def create_tables(self):
@@ -44,7 +80,7 @@ class StockDB:
         PRIMARY KEY (股號, 日期)
     )
     ''')   # ↑以股號+日期為主鍵
-    self.conn.execute('CREATE INDEX 日期索引 ON 日頻(日期)') #建日期索引
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 日期索引 ON 日頻(日期)') #建日期索引
 
 
     self.conn.execute('''
@@ -57,9 +93,170 @@ class StockDB:
         PRIMARY KEY (股號, 年份, 季度)
     )
     ''')
+    self.create_progress_table()
+    self.create_indicator_table()
 
     self.conn.commit()
 
+  ##############################
+  ## 資料庫結構的版本遷移 ##
+  ##############################
+
+  # 依序執行的遷移(版本, 方法名稱), 目前版本記錄在 PRAGMA user_version
+  # 新增遷移時只能加在最後, 已發布的遷移不可修改
+  MIGRATIONS = [
+    (1, 'create_tables'),        # 基本資料表
+    (2, 'migrate_affinity'),     # 修正欄位型別
+    (3, 'migrate_quarter_date'), # 季頻加入季末日欄位
+    (4, 'migrate_indexes'),      # 常用查詢的覆蓋索引
+    (5, 'create_fundamental_table'), # 基本面成長率
+    (6, 'migrate_indicator_index'),  # 指標的日期索引
+  ]
+
+  # 目前的結構版本
+  def schema_version(self):
+    return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+  # 執行尚未套用的遷移, 每個遷移在各自的交易中完成, 失敗則還原且版本不變
+  def migrate(self):
+    self.conn.commit()
+    for version, name in self.MIGRATIONS:
+      if self.schema_version() >= version:
+        continue
+      print(f"資料庫結構升級至第 {version} 版：{name}")
+      self.conn.execute('BEGIN')
+      try:
+        getattr(self, name)()
+        self.conn.execute(f'PRAGMA user_version = {version}')
+        self.conn.commit()
+      except Exception:
+        self.conn.rollback()
+        raise
+
+  # 以新的定義重建資料表並複製資料(SQLite 無法直接修改欄位型別)
+  # columns 為新表各欄位的 SELECT 運算式
+  def rebuild_table(self, table, create_sql, columns):
+    self.conn.execute(f'DROP TABLE IF EXISTS {table}_new')
+    self.conn.execute(create_sql.format(table=f'{table}_new'))
+    names = ', '.join(columns)
+    values = ', '.join(columns.values())
+    self.conn.execute(f'INSERT INTO {table}_new ({names}) SELECT {values} FROM {table}')
+    self.conn.execute(f'DROP TABLE {table}')
+    self.conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+  # 數值欄位中含千分位或 "--" 等文字的值, 轉為 REAL 或 NULL
+  @staticmethod
+  def to_real_sql(column):
+    text = f"REPLACE({column}, ',', '')"
+    return (f"CASE WHEN typeof({column}) != 'text' THEN {column} "
+            f"WHEN {text} GLOB '*[0-9]*' AND {text} NOT GLOB '*[^0-9.+-]*' THEN CAST({text} AS REAL) END")
+
+  DAILY_SQL = '''
+    CREATE TABLE {table} (
+        股號 TEXT,
+        日期 TEXT,
+        開盤價 REAL,最高價 REAL,最低價 REAL,
+        收盤價 REAL,還原價 REAL,成交量 INTEGER,
+        日報酬 REAL,殖利率 REAL,日本益比 REAL,
+        股價淨值比 REAL,三大法人買賣超股數 REAL,
+        融資買入 REAL,融卷賣出 REAL,
+        PRIMARY KEY (股號, 日期)
+    )'''
+
+  # 版本 2：收盤價/還原價原本誤寫為 READ(NUMERIC 型別), 季度原為 REAL(實際存 "Q1" 等文字)
+  #        並將證交所資料中含千分位的文字轉為數值
+  def migrate_affinity(self):
+    real_columns = ['殖利率', '日本益比', '股價淨值比', '三大法人買賣超股數', '融資買入', '融卷賣出']
+    columns = {c: c for c in ['股號', '日期', '開盤價', '最高價', '最低價', '收盤價', '還原價',
+                              '成交量', '日報酬']}
+    columns.update({c: self.to_real_sql(c) for c in real_columns})
+    self.rebuild_table('日頻', self.DAILY_SQL, columns)
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 日期索引 ON 日頻(日期)')
+
+    self.rebuild_table('季頻', '''
+    CREATE TABLE {table} (
+        股號 TEXT,
+        年份 TEXT,
+        季度 TEXT,營業收入 REAL,
+        營業費用 REAL,稅後淨利 REAL,
+        每股盈餘 REAL,
+        PRIMARY KEY (股號, 年份, 季度)
+    )''', {c: c for c in ['股號', '年份', '季度', '營業收入', '營業費用', '稅後淨利', '每股盈餘']})
+
+  # 版本 3：季頻加入季末日(如 "2024-09-30"), 由年份及季度自動產生並儲存, 可建立索引
+  #        取代每次查詢時以 strftime/CASE 組出日期
+  def migrate_quarter_date(self):
+    self.rebuild_table('季頻', '''
+    CREATE TABLE {table} (
+        股號 TEXT,
+        年份 TEXT,
+        季度 TEXT,營業收入 REAL,
+        營業費用 REAL,稅後淨利 REAL,
+        每股盈餘 REAL,
+        季末日 TEXT GENERATED ALWAYS AS (年份 || CASE 季度
+            WHEN 'Q1' THEN '-03-31' WHEN 'Q2' THEN '-06-30'
+            WHEN 'Q3' THEN '-09-30' WHEN 'Q4' THEN '-12-31' END) STORED,
+        PRIMARY KEY (股號, 年份, 季度)
+    )''', {c: c for c in ['股號', '年份', '季度', '營業收入', '營業費用', '稅後淨利', '每股盈餘']})
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 季末日索引 ON 季頻(季末日)')
+
+  # 版本 4：覆蓋索引, 查詢只需讀索引不必回表
+  #   股號+日期範圍的價量查詢、各股最新一季、以及依日期查詢有開盤價的資料
+  def migrate_indexes(self):
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 日頻價量索引 ON 日頻(股號, 日期, 收盤價, 還原價, 成交量)')
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 日頻開盤索引 ON 日頻(日期, 開盤價)')
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 季頻股號季末日索引 ON 季頻(股號, 季末日)')
+    self.conn.execute('ANALYZE')
+
+  # 版本 5：基本面表, 由季頻計算的營收成長率及 EPS 季增率, 以股號+季末日為主鍵
+  #        並由既有的季頻資料填入(在遷移的交易中寫入, 不經過 upsert 的 commit)
+  def create_fundamental_table(self):
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 基本面 (
+        股號 TEXT,
+        季末日 TEXT,
+        營業收入 REAL,營收成長率 REAL,
+        EPS REAL,EPS季增率 REAL,
+        PRIMARY KEY (股號, 季末日)
+    )
+    ''')
+    df = self.get('季頻', ['股號', '季末日', '營業收入', '每股盈餘'])
+    if not df.empty:
+      df = self.compute_fundamentals(df)
+      self.conn.executemany(f"INSERT OR REPLACE INTO 基本面 ({', '.join(df.columns)}) VALUES "
+                            f"({', '.join('?' * len(df.columns))})",
+                            df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+  # 版本 6：指標的日期索引, renew_derived 由此取得已計算到的最後日期, 不必掃描整個指標表
+  def migrate_indicator_index(self):
+    self.create_indicator_table()
+    self.conn.execute('CREATE INDEX IF NOT EXISTS 指標日期索引 ON 指標(日期)')
+
+  # 技術指標表：由日頻的還原價及成交量計算, 以股號+日期為主鍵
+  def create_indicator_table(self):
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 指標 (
+        股號 TEXT,
+        日期 TEXT,
+        均線5 REAL,均線20 REAL,均線60 REAL,
+        波動率20 REAL,均量20 REAL,
+        高52週 REAL,低52週 REAL,
+        PRIMARY KEY (股號, 日期)
+    )
+    ''')
+
+  # 季頻更新進度表：記錄每檔股票已完成的報告季, 中斷後可從該處繼續
+  def create_progress_table(self):
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 季頻進度 (
+        股號 TEXT PRIMARY KEY NOT NULL,
+        報告季 TEXT,
+        狀態 TEXT,
+        訊息 TEXT,
+        更新時間 TEXT
+    )
+    ''')
+
   # 更新股票資訊
   def renew(self, if_renew_qu = True):
     self.renew_company() # 公司的基本資訊
@@ -92,9 +289,33 @@ class StockDB:
   # 讀取資料 (可有多個資料表, 以逗號分隔, 此時要加上 where 條件。
   #       若有同名欄位, 則要寫成 "資料表.欄位")
   # 參數 psdate (parse_date) 表示是否將日期欄的資料轉為日期型別,預設為 True
+  # 參數 stocks, start, end 為股號清單及日期範圍(含), 會以參數化查詢加入條件
+  # 參數 engine='columnar' 表示改由日頻的 Parquet 鏡像讀取(只讀需要的分割及欄位)
   # 傳回 DataFrame
-  def get(self, table, select=None, where=None, psdate=False): #參數：資料表, 欄位, 條件式, 解析日期欄
+  def get(self, table, select=None, where=None, psdate=False,
+          stocks=None, start=None, end=None, engine='sqlite'): #參數：資料表, 欄位, 條件式, 解析日期欄
+    if engine == 'columnar':
+      return self.get_columnar(table, select, where, psdate, stocks, start, end)
     # 查詢資料
+    sql, params = self.build_query(table, select, where, stocks, start, end)
+    parse_dates = None
+    if psdate: # 要解析日期欄位, 將之轉為日期型別
+      if table == '季頻': # 以儲存的季末日作為日期欄
+        sql, params = self.build_query(table, '股號, 季末日 AS 日期, 營業收入, 營業費用, 稅後淨利, 每股盈餘',
+                                       where, stocks, start, end)
+        sql += ' ORDER BY 股號 ASC, 日期 DESC'
+        parse_dates = ['日期']
+      else:
+        parse_dates = self.parse_columns(table)
+    with self.lock:
+      df = pd.read_sql(sql, self.conn, params=params, parse_dates=parse_dates)
+    return df
+
+  # 各資料表用來篩選日期範圍的欄位
+  DATE_COLUMNS = {'日頻': '日期', '季頻': '季末日', '指標': '日期'}
+
+  # 組成查詢的 SQL 及參數, stocks 可為單一股號或清單, start/end 為 "2024-01-31" 格式的字串
+  def build_query(self, table, select=None, where=None, stocks=None, start=None, end=None):
     if not isinstance(table, str): #如果不是字串, 就將元素以逗號組合
       table = ", ".join(table)
 
@@ -103,38 +324,209 @@ class StockDB:
     elif not isinstance(select, str): #如果不是字串, 就將元素以逗號組合
       select = ", ".join(select)
 
+    conditions, params = [], []
+    if where:
+      conditions.append(f"({where})")
+    if stocks is not None:
+      if isinstance(stocks, str):
+        stocks = [stocks]
+      stocks = list(stocks)
+      conditions.append(f"股號 IN ({', '.join('?' * len(stocks))})")
+      params += stocks
+    date_column = self.DATE_COLUMNS.get(table)
+    for value, op in ((start, '>='), (end, '<=')):
+      if value is None:
+        continue
+      if date_column is None:
+        raise ValueError(f"{table} 沒有可篩選日期的欄位")
+      value = str(value)[:10]
+      conditions.append(f"{date_column} {op} ?")
+      params.append(value)
 
     sql = f"SELECT {select} FROM {table}"
+    if conditions:
+      sql += " WHERE " + " AND ".join(conditions)
+    return sql, params
+
+  # 要轉為日期型別的欄位
+  def parse_columns(self, table):
+    return ['日期'] if table == '日頻' else None
+
+  # 串流讀取資料：每次產生 chunksize 筆, 記憶體用量與資料庫大小無關
+  # 參數同 get; rows=True 時產生 tuple 串列(不轉為 DataFrame, 最省記憶體)
+  # 例如：for df in db.iter_get('日頻', ['股號', '日期', '收盤價'], stocks=['2330'], start='2024-01-01'):
+  def iter_get(self, table, select=None, where=None, psdate=False,
+               stocks=None, start=None, end=None, chunksize=100000, rows=False):
+    sql, params = self.build_query(table, select, where, stocks, start, end)
+    # 每次讀取一批時才持有鎖, 處理資料時不會擋住其他執行緒
+    if rows:
+      with self.lock:
+        cursor = self.conn.execute(sql, params)
+      while True:
+        with self.lock:
+          batch = cursor.fetchmany(chunksize)
+        if not batch:
+          break
+        yield batch
+    else:
+      parse_dates = self.parse_columns(table) if psdate else None
+      with self.lock:
+        chunks = pd.read_sql(sql, self.conn, params=params, chunksize=chunksize,
+                             parse_dates=parse_dates)
+      while True:
+        with self.lock:
+          chunk = next(chunks, None)
+        if chunk is None:
+          break
+        yield chunk
+
+  ##############################
+  ## 日頻的欄式(Parquet)鏡像 ##
+  ##############################
+
+  # 鏡像的欄位型別; SQLite 仍是正式資料, 鏡像只供快速分析讀取
+  DAILY_TYPES = {
+    '股號': 'string', '日期': 'string',
+    '開盤價': 'float64', '最高價': 'float64', '最低價': 'float64',
+    '收盤價': 'float64', '還原價': 'float64', '成交量': 'int64',
+    '日報酬': 'float64', '殖利率': 'float64', '日本益比': 'float64',
+    '股價淨值比': 'float64', '三大法人買賣超股數': 'float64',
+    '融資買入': 'float64', '融卷賣出': 'float64',
+  }
+
+  def check_pyarrow(self):
+    if pa is None:
+      raise ImportError("欄式鏡像需要 pyarrow, 請先執行 pip install pyarrow")
+
+  # 鏡像是否已完整建立過(全部年份都寫入後才會有 _完整 檔案, _ 開頭的檔案讀取時會被忽略)
+  def columnar_complete(self):
+    return os.path.exists(os.path.join(self.columnar_path, '_完整'))
+
+  # 依年份重建鏡像的分割(year=None 表示全部年份), 每個年份先寫到暫存資料夾再換上
+  # 鏡像尚未完整建立時(例如舊資料庫剛開啟 columnar)一律重建全部年份, 以免只有部分年份
+  def sync_columnar(self, years=None):
+    self.check_pyarrow()
+    full = years is None or not self.columnar_complete()
+    if full:
+      cursor = self.conn.execute("SELECT DISTINCT substr(日期, 1, 4) FROM 日頻")
+      years = [row[0] for row in cursor.fetchall() if row[0]]
+    os.makedirs(self.columnar_path, exist_ok=True)
+    for year in sorted({int(y) for y in years}):
+      start = time.perf_counter()
+      df = self.get('日頻', start=f'{year}-01-01', end=f'{year}-12-31')
+      # 部分欄位是含千分位的字串(如 "1,000"), 轉為數值
+      for column, dtype in self.DAILY_TYPES.items():
+        if dtype != 'string' and not pd.api.types.is_numeric_dtype(df[column]):
+          df[column] = pd.to_numeric(df[column].astype(str).str.replace(',', ''), errors='coerce')
+      df = df.astype({'股號': str, '日期': str})
+      df['成交量'] = df['成交量'].astype('Int64')
+      df = df.sort_values(['股號', '日期'])
+      schema = pa.schema([(c, pa.string() if t == 'string' else pa.from_numpy_dtype(t))
+                          for c, t in self.DAILY_TYPES.items()])
+
+      final_dir = os.path.join(self.columnar_path, f'年={year}')
+      tmp_dir = os.path.join(self.columnar_path, f'_tmp_{year}') # _ 開頭的資料夾讀取時會被忽略
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      os.makedirs(tmp_dir)
+      if self.partition_stock: # 依股號分割, 股號由資料夾名稱取得
+        for stock, stock_df in df.groupby('股號', sort=False):
+          stock_dir = os.path.join(tmp_dir, f'股號={stock}')
+          os.makedirs(stock_dir)
+          stock_table = pa.Table.from_pandas(stock_df, schema=schema, preserve_index=False)
+          pq.write_table(stock_table.drop_columns(['股號']), os.path.join(stock_dir, 'part-0.parquet'))
+      else:
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        pq.write_table(table, os.path.join(tmp_dir, 'part-0.parquet'))
+      shutil.rmtree(final_dir, ignore_errors=True)
+      os.replace(tmp_dir, final_dir)
+      print(f"欄式鏡像 {year} 年：{len(df)} 筆, 耗時 {time.perf_counter() - start:.2f} 秒")
+    if full:
+      with open(os.path.join(self.columnar_path, '_完整'), 'w', encoding='utf-8') as f:
+        f.write(datetime.now().isoformat(timespec='seconds'))
+
+  # 從鏡像讀取日頻資料, 只讀取需要的年份分割及欄位, 並以記憶體映射(mmap)讀檔
+  def get_columnar(self, table, select=None, where=None, psdate=False, stocks=None, start=None, end=None):
+    self.check_pyarrow()
+    if table != '日頻':
+      raise ValueError("欄式鏡像只有日頻資料表")
     if where:
-      sql += f" WHERE {where}"
-    if psdate: # 要解析日期欄位, 將之轉為日期型別
-      if table == '日頻':
-        df = pd.read_sql(sql, self.conn, parse_dates=['日期'])
-      elif table == '季頻':
-        sql = '''
-        SELECT 股號, 
-            營業收入, 
-            營業費用, 
-            稅後淨利, 
-            每股盈餘,
-            strftime('%Y-%m-%d', 年份 || '-' || 
-            CASE 
-                WHEN 季度 = 'Q1' THEN '03' 
-                WHEN 季度 = 'Q2' THEN '06'
-                WHEN 季度 = 'Q3' THEN '09'
-                WHEN 季度 = 'Q4' THEN '12'
-            END || '-01') as 日期
-            
-        FROM 季頻
-        ORDER BY 股號 ASC, 日期 DESC'''
-        df = pd.read_sql(sql, self.conn, parse_dates=['日期']) 
-        column_order = ['股號', '日期', '營業收入', '營業費用', '稅後淨利', '每股盈餘']
-        df = df[column_order]
-        
+      raise ValueError("欄式鏡像不支援 where 字串, 請改用 stocks/start/end 參數")
+    if not self.columnar_complete():
+      self.sync_columnar()
+    partition_fields = [('年', pa.int16())]
+    if self.partition_stock:
+      partition_fields.append(('股號', pa.string()))
+    dataset = ds.dataset(self.columnar_path, format='parquet',
+                         filesystem=pafs.LocalFileSystem(use_mmap=True),
+                         partitioning=ds.partitioning(pa.schema(partition_fields), flavor='hive'))
+    conditions = []
+    if stocks is not None:
+      stocks = [stocks] if isinstance(stocks, str) else list(stocks)
+      conditions.append(ds.field('股號').isin(stocks))
+    if start is not None:
+      start = str(start)[:10]
+      conditions += [ds.field('年') >= int(start[:4]), ds.field('日期') >= start]
+    if end is not None:
+      end = str(end)[:10]
+      conditions += [ds.field('年') <= int(end[:4]), ds.field('日期') <= end]
+    condition = None
+    for c in conditions:
+      condition = c if condition is None else condition & c
+    if not select or select == '*':
+      columns = list(self.DAILY_TYPES)
+    elif isinstance(select, str):
+      columns = [c.strip() for c in select.split(',')]
     else:
-      df = pd.read_sql(sql, self.conn)
+      columns = list(select)
+    df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if psdate and '日期' in df.columns:
+      df['日期'] = pd.to_datetime(df['日期'])
     return df
 
+  # 快速寫入模式：WAL 日誌、放寬 synchronous、加大快取(KB 為單位, 負值)
+  # 斷電時可能遺失最後幾筆交易, 但資料庫不會損毀; enable=False 則還原為預設值
+  def fast_ingest(self, enable=True, cache_kb=262144):
+    if enable:
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      self.conn.execute("PRAGMA synchronous=NORMAL")
+      self.conn.execute(f"PRAGMA cache_size=-{cache_kb}")
+    else:
+      self.conn.execute("PRAGMA journal_mode=DELETE")
+      self.conn.execute("PRAGMA synchronous=FULL")
+      self.conn.execute("PRAGMA cache_size=-2000")
+
+  # 取得資料表的主鍵欄位(依主鍵順序)
+  def primary_keys(self, table):
+    columns = self.conn.execute(f"PRAGMA table_info({table})").fetchall()
+    return [c[1] for c in sorted(columns, key=lambda c: c[5]) if c[5] > 0]
+
+  # 大量寫入：以 executemany 執行 INSERT ... ON CONFLICT DO UPDATE,
+  # 主鍵重複時改為更新該筆資料, 全部在同一個交易中完成(失敗則整批還原)
+  # 傳回寫入筆數, 並顯示每秒寫入筆數
+  def upsert(self, table, df):
+    if df is None or df.empty:
+      return 0
+    keys = self.primary_keys(table)
+    columns = list(df.columns)
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    updates = [c for c in columns if c not in keys]
+    if keys and updates:
+      sql += f" ON CONFLICT({', '.join(keys)}) DO UPDATE SET "
+      sql += ", ".join(f"{c}=excluded.{c}" for c in updates)
+    elif keys:
+      sql += " ON CONFLICT DO NOTHING"
+    # 轉為 Python 物件, 並將 NaN 改為 None(NULL)
+    data = df.astype(object).where(df.notna(), None)
+    start = time.perf_counter()
+    with self.lock, self.conn: # 交易：成功則 commit, 發生例外則 rollback
+      self.conn.executemany(sql, data.itertuples(index=False, name=None))
+    seconds = time.perf_counter() - start
+    rows = len(df)
+    self.last_ingest = {'資料表': table, '筆數': rows, '秒數': seconds,
+                        '每秒筆數': rows / seconds if seconds > 0 else float('inf')}
+    print(f"{table} 寫入 {rows} 筆, 耗時 {seconds:.2f} 秒, 每秒 {self.last_ingest['每秒筆數']:,.0f} 筆")
+    return rows
+
   # 關閉資料庫
   def close(self):
     self.conn.close()
@@ -147,137 +539,214 @@ class StockDB:
   #讀取最近一天所有股票的日頻資料, 以取得最新的股號及股名清單
   #欄位："股號","股名","成交量","成交金額","開盤價","最高價","最低價","收盤價","漲跌價差","成交筆數"
 
-  # 上市股票
+  # 上市股票(由 TickerUniverse 讀取, 只含股票區段)
   def stock_name(self):
     # print(self.ids)
     if self.ids is not None:
       return self.ids
-    print("線上讀取股號、股名、及產業別")
-    data=[]
-    response=requests.get('https://isin.twse.com.tw/isin/C_public.jsp?strMode=2')
-    url_data=BeautifulSoup(response.text, 'html.parser')
-    stock_company=url_data.find_all('tr')
-    for i in stock_company[2:]:
-        j=i.find_all('td')
-        l=j[0].text.split('\u3000')
-        if len(l[0].strip()) == 4:
-            stock_id,stock_name = l
-            industry = j[4].text.strip()
-            data.append([stock_id.strip(),stock_name,industry])
-        else:
-            break
-    df = pd.DataFrame(data, columns=['股號','股名','產業別'])
+    df = self.universe.frame(stocks_only=True)
     self.ids = df
     return df
 
   #更新公司基本資料, 預設只會加入新上市的公司, 若將參數all設為Ture則全部更新
-  def renew_company(self, all=False):
+  # 以 workers 個執行緒平行讀取 yfinance, 讀取失敗的股號會記錄在 self.company_retry,
+  # 可用 renew_company(ids=db.company_retry) 重試
+  def renew_company(self, all=False, workers=8, ids=None):
     df_old = self.get("公司", '股號,股名,產業別')
-    if all or df_old.empty: # 先刪除全部, 再重新讀取
-      self.conn.execute("DELETE FROM 公司")
-      df = self.stock_name()
+    df_new = self.stock_name()
+    if ids is not None: # 只更新指定的公司
+      df = df_new[df_new['股號'].isin(ids)]
+      print('重新更新的公司：', df)
+    elif all or df_old.empty: # 全部重新讀取, 並刪除已下市的公司
+      df = df_new
       print('更新所有的公司：', df)
     else:
-      df_new = self.stock_name()
       mask = df_new['股號'].isin(df_old['股號']) # 建立在new存在,在old也存在的遮罩
       df = df_new[~mask] #反轉遮罩, 取出在new有在old沒有的資料
       print('要更新的公司：', df)
 
-    for id,name,industry in zip(df['股號'],df['股名'],df['產業別']):
-      try:
-        stock = yf.Ticker(id+".TW")
-        if not 'sharesOutstanding' in stock.info:
-          stock_sharesOutstanding = None
-        else:
-          stock_sharesOutstanding=stock.info['sharesOutstanding']
-        if not 'marketCap' in stock.info:
-          stock_marketCap = None
-        else:
-          stock_marketCap=stock.info['marketCap']
-  
-        self.conn.execute("INSERT INTO 公司 values(?,?,?,?,?)",
-                  (id,name,industry,stock_sharesOutstanding,stock_marketCap))
-        self.conn.commit()
-        # print(id)
-      except:
-        pass
+    rows = []
+    self.company_retry = []
+    with ThreadPoolExecutor(workers) as pool:
+      futures = {pool.submit(self.company_info, id): (id, name, industry)
+                 for id, name, industry in zip(df['股號'], df['股名'], df['產業別'])}
+      for future in as_completed(futures):
+        id, name, industry = futures[future]
+        try:
+          rows.append((id, name, industry, *future.result()))
+        except Exception as e:
+          print(f"{id} 讀取失敗：{e}")
+          self.company_retry.append(id)
+
+    # 刪除及寫入在同一個交易中完成
+    with self.lock:
+      if ids is None and (all or df_old.empty):
+        self.conn.execute(f"DELETE FROM 公司 WHERE 股號 NOT IN ({', '.join('?' * len(df))})",
+                          df['股號'].tolist())
+      self.upsert('公司', pd.DataFrame(rows, columns=['股號', '股名', '產業別', '股本', '市值']))
+      self.conn.commit()
+    if self.company_retry:
+      print(f"共 {len(self.company_retry)} 家公司讀取失敗, 已記錄於 company_retry")
+
+  # 讀取單一公司的股本及市值(.info 只讀取一次)
+  def company_info(self, id):
+    info = yf.Ticker(id + ".TW").info
+    return info.get('sharesOutstanding'), info.get('marketCap')
 
   def quarter_to_int(self, year, quarter):
     quarter_dict = {"Q1": 1, "Q2": 2, "Q3": 3, "Q4": 4}
     return int(year) * 10 + quarter_dict[quarter]
 
+  # 目前應已公布的最新財報季度, 傳回 (年份, 季度), 例如 ('2024', 'Q3')
+  # 公布期限：Q1 5/15, Q2 8/14, Q3 11/14, Q4 隔年 3/31
+  def report_quarter(self, today=None):
+    today = today or datetime.now()
+    y = today.year
+    if datetime(y, 5, 15) <= today < datetime(y, 8, 14):
+      return str(y), "Q1"
+    if datetime(y, 8, 14) <= today < datetime(y, 11, 14):
+      return str(y), "Q2"
+    if today >= datetime(y, 11, 14):
+      return str(y), "Q3"
+    if today < datetime(y, 3, 31):
+      return str(y - 1), "Q3"
+    return str(y - 1), "Q4"
+
+  # 找出季頻最新一季落後於指定季度的股號
+  def stale_quarterly(self, year, quarter):
+    expected = self.quarter_to_int(year, quarter)
+    cursor = self.conn.execute('''
+    SELECT 股號, MAX(CAST(年份 AS INTEGER) * 10 + CAST(substr(季度, 2) AS INTEGER))
+    FROM 季頻 GROUP BY 股號''')
+    latest = dict(cursor.fetchall())
+    return [id for id in self.stock_name()['股號'] if (latest.get(id) or 0) < expected]
+
   # 更新季頻的基本資訊
-  def renew_quarterly_frequency_basic(self):
-    #找出最後更新日期
-    cursor = self.conn.execute('SELECT 年份, 季度 FROM 季頻 ORDER BY 年份 DESC, 季度 DESC LIMIT 1')
-    m_date = cursor.fetchone()
-    latest_year, latest_quarter = m_date
-    print('季頻基本資料的最後更新日：', m_date)  #for debug
-    today = datetime.now()
-    q1_release = datetime(today.year, 5, 15)
-    q2_release = datetime(today.year, 8, 14)
-    q3_release = datetime(today.year, 11, 14)
-    q4_release = datetime(today.year, 3, 31)
-    if q1_release <= today < q2_release:
-        report_type = "Q1"
-    elif q2_release <= today < q3_release:
-        report_type = "Q2"
-    elif q3_release <= today <  datetime(today.year + 1, 3, 31) or datetime(today.year - 1, 11, 14) <= today < q4_release:
-        report_type = "Q3"
-    elif q4_release <= today < q1_release:
-        report_type = "Q4"
-    
-    print(f"當前狀態: {report_type}")
-    
-    if report_type == latest_quarter:
+  # 只更新最新一季落後的股票; 以 workers 個執行緒同時下載損益表及 EPS 頁面,
+  # 再交給 parse_workers 個子行程解析, 每 batch 檔寫入一次並記錄於 季頻進度,
+  # 中斷後重新執行會略過本季已完成的股票
+  def renew_quarterly_frequency_basic(self, workers=8, parse_workers=4, batch=50):
+    year, quarter = self.report_quarter()
+    report = f"{year} {quarter}"
+    print(f"當前狀態: {report}")
+    self.create_progress_table()
+    cursor = self.conn.execute("SELECT 股號 FROM 季頻進度 WHERE 報告季 = ? AND 狀態 = '完成'", (report,))
+    done = {row[0] for row in cursor.fetchall()}
+    ids = [id for id in self.stale_quarterly(year, quarter) if id not in done]
+    if not ids:
+      # 升級前已建立空白基本面表的資料庫, 在季頻不必更新時也要補算
+      if self.conn.execute('SELECT 1 FROM 基本面 LIMIT 1').fetchone() is None:
+        self.renew_fundamentals()
       return print("不用更新")
-    else:
-      #更新季頻資料表
-      print('更新季頻')
-      
-      df = self.stock_name()
-      for id, name in zip(df['股號'],df['股名']):
-          df_data=[]
-          url = [f'https://tw.stock.yahoo.com/quote/{id}.TW/income-statement',
-                  f'https://tw.stock.yahoo.com/quote/{id}.TW/eps']
-          df = self.url_find(url[0])
-          print(id)
-          df = df.transpose()
-          df.columns = df.iloc[0]
-          df = df[1:]
-          df.insert(0,'年度/季別',df.index)
-          df.columns.name = None
-          df.reset_index(drop=True, inplace=True)
-          df_data.append(df)
-  
-          # 季EPS表
-          df=self.url_find(url[1])
-          df_data.append(df)
-  
-          # 將兩個 DataFrame 按列名合併
-          combined_df = df_data[0].merge(df_data[1], on='年度/季別')
-          # print 合併後的DataFrame
-          combined_df=combined_df.iloc[:,[0,1,3,5,6]]
-          combined_df[['年份', '季度']] = combined_df['年度/季別'].str.split(' ', expand=True)
-          combined_df.drop(columns=['年度/季別'], inplace=True)
-  
-          # 重新排列列的顺序
-          combined_df = combined_df[['年份', '季度', '營業收入', '營業費用', '稅後淨利', '每股盈餘']]
-          combined_df.insert(0, '股號', id)   # 加入股號欄
-          try:
-            combined_df.to_sql('季頻', self.conn, if_exists='append', index=False)
-          except:
+    #更新季頻資料表
+    print(f'更新季頻：{len(ids)} 檔')
+
+    pages = {}          # 已下載但尚未湊齊兩個頁面的股票
+    quarterly_list = [] # 尚未寫入的季頻資料
+    progress = []       # 尚未寫入的進度
+    def finish(id, status, msg=None):
+      progress.append((id, report, status, msg, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    with ProcessPoolExecutor(parse_workers) as parse_pool:
+      parse_pool.submit(int).result() # 先啟動子行程, 避免在下載執行緒啟動後才 fork
+      with ThreadPoolExecutor(workers) as fetch_pool:
+        tasks = {}
+        for id in ids:
+          for k in ('income-statement', 'eps'):
+            url = f'{self.YAHOO_URL}/quote/{id}.TW/{k}'
+            tasks[fetch_pool.submit(self.fetch_page, url)] = (id, k)
+        pending = set(tasks)
+        while pending:
+          finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+          for future in finished:
+            id, k = tasks.pop(future)
+            if k == 'parse': # 解析完成
+              try:
+                df = future.result()
+              except Exception as e:
+                finish(id, '失敗', f'解析失敗：{e}')
+                continue
+              quarterly_list.append(df)
+              # 網頁尚未有本季財報時記為 未公布, 下次執行會再重試
+              if ((df['年份'] == year) & (df['季度'] == quarter)).any():
+                finish(id, '完成')
+              else:
+                finish(id, '未公布', f'網頁尚無 {report} 的資料')
               continue
-      return print("更新完成")
-   
+            try:
+              pages.setdefault(id, {})[k] = future.result()
+            except Exception as e:
+              pages.setdefault(id, {})[k] = e
+            if len(pages[id]) < 2:
+              continue
+            page = pages.pop(id)
+            errors = [v for v in page.values() if isinstance(v, Exception)]
+            if errors:
+              finish(id, '失敗', f'下載失敗：{errors[0]}')
+              continue
+            parse_future = parse_pool.submit(StockDB.parse_quarterly, id,
+                                              page['income-statement'], page['eps'])
+            tasks[parse_future] = (id, 'parse')
+            pending.add(parse_future)
+          if len(progress) >= batch:
+            self.save_quarterly(quarterly_list, progress)
+    self.save_quarterly(quarterly_list, progress)
+    cursor = self.conn.execute("SELECT 狀態, COUNT(*) FROM 季頻進度 WHERE 報告季 = ? GROUP BY 狀態", (report,))
+    counts = dict(cursor.fetchall())
+    print(f"失敗 {counts.get('失敗', 0)} 檔, 尚未公布 {counts.get('未公布', 0)} 檔, 重新執行即可重試")
+    self.renew_fundamentals()
+    return print("更新完成")
+
+  # 寫入季頻資料及進度(先寫資料再寫進度, 中斷時最多重抓一批), 並清空兩個串列
+  def save_quarterly(self, quarterly_list, progress):
+    if quarterly_list:
+      self.upsert('季頻', pd.concat(quarterly_list, ignore_index=True))
+    if progress:
+      with self.lock, self.conn:
+        self.conn.executemany("INSERT OR REPLACE INTO 季頻進度 VALUES (?,?,?,?,?)", progress)
+    quarterly_list.clear()
+    progress.clear()
+
+  # 解析單一股票的損益表及 EPS 頁面, 合併為季頻資料表的格式
+  @staticmethod
+  def parse_quarterly(id, income_html, eps_html):
+    df_data=[]
+    df = StockDB.parse_table(income_html, 'income-statement')
+    df = df.transpose()
+    df.columns = df.iloc[0]
+    df = df[1:]
+    df.insert(0,'年度/季別',df.index)
+    df.columns.name = None
+    df.reset_index(drop=True, inplace=True)
+    df_data.append(df)
+
+    # 季EPS表
+    df = StockDB.parse_table(eps_html, 'eps')
+    df_data.append(df)
+
+    # 將兩個 DataFrame 按列名合併
+    combined_df = df_data[0].merge(df_data[1], on='年度/季別')
+    combined_df=combined_df.iloc[:,[0,1,3,5,6]]
+    combined_df[['年份', '季度']] = combined_df['年度/季別'].str.split(' ', expand=True)
+    combined_df.drop(columns=['年度/季別'], inplace=True)
+
+    # 重新排列列的顺序
+    combined_df = combined_df[['年份', '季度', '營業收入', '營業費用', '稅後淨利', '每股盈餘']]
+    combined_df.insert(0, '股號', id)   # 加入股號欄
+    return combined_df
+
+  # 經由快取下載網頁內容(失敗時自動重試)
+  def fetch_page(self, url):
+    return self.http.get(url).content
 
   def url_find(self,url):
     words = url.split('/')
     k = words[-1]
-    # 使用requests取得網頁內容
-    response = requests.get(url)
-    html = response.content
+    return self.parse_table(self.fetch_page(url), k)
 
+  # 解析 Yahoo 股市的表格頁面, k 為頁面名稱(例如 eps)
+  @staticmethod
+  def parse_table(html, k):
     # 使用Beautiful Soup解析HTML內容
     soup = BeautifulSoup(html, 'html.parser')
 
@@ -325,54 +794,97 @@ class StockDB:
 
         return yf_df
 
+  # 進階日頻資料的三個來源：本益比、法人買賣超、融資融券
+  def advanced_urls(self, date):
+    return [
+        f"{self.TWSE_URL}/rwd/zh/afterTrading/BWIBBU_d?date={date}&selectType=ALL&response=json",
+        f"{self.TWSE_URL}/rwd/zh/fund/T86?date={date}&selectType=ALLBUT0999&response=json",
+        f"{self.TWSE_URL}/rwd/zh/marginTrading/MI_MARGN?date={date}&selectType=STOCK&response=json"
+    ]
+
+  # 經由快取讀取 JSON
+  def get_json(self, url):
+    return self.http.get(url, fetch=self.fetch_twse).json()
+
+  # 經由限速器連線證交所, 回應不是 JSON(例如被擋時的網頁)也會重試, 以免寫入快取
+  def fetch_twse(self, url, headers=None):
+    def check(response):
+      if response.status_code != 304:
+        response.json()
+      return response
+    return get_with_retry(url, limiter=self.limiter, parse=check, headers=headers)
+
   # 進階日頻資料下載
   def stock_advanced(self, date):
-      urls = [
-          f"https://www.twse.com.tw/rwd/zh/afterTrading/BWIBBU_d?date={date}&selectType=ALL&response=json",
-          f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date}&selectType=ALLBUT0999&response=json",
-          f"https://www.twse.com.tw/rwd/zh/marginTrading/MI_MARGN?date={date}&selectType=STOCK&response=json"
-      ]
-      # 取得本益比資料
-      json_data1=requests.get(urls[0]).json()
-      # 有資料才執行程式
-      if 'stat' in json_data1 and json_data1['stat'] == 'OK':
-          df1 = pd.DataFrame(json_data1['data'], columns=json_data1['fields'])
-          df1 = df1[['證券代號','殖利率(%)','本益比','股價淨值比']]
-          df1.insert(1, '日期', datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%d'))
-          df1.rename(columns={
-                  '證券代號':'股號','殖利率(%)':'殖利率','本益比':'日本益比'
-                  }, inplace=True)
-      time.sleep(2)
-      # 取得法人買賣超資料
-      json_data2=requests.get(urls[1]).json()
-      if 'stat' in json_data2 and json_data2['stat'] == 'OK':
-          df2 = pd.DataFrame(json_data2['data'], columns=json_data2['fields'])
-          df2 = df2[['證券代號','三大法人買賣超股數']]
-          df2.rename(columns={
-                  '證券代號':'股號'
-                  }, inplace=True)
-      time.sleep(2)
-      # 取得融資融券資料
-      json_data3=requests.get(urls[2]).json()
-      if 'stat' in json_data3 and json_data3['stat'] == 'OK':
-          data = pd.DataFrame(json_data3['tables'][1]['data'])
-          df3 = data.iloc[:, [0, 2, 9]]
-          df3.columns = ['股號', '融資買入', '融卷賣出']
-      time.sleep(2)
+    json_list = [self.get_json(url) for url in self.advanced_urls(date)]
+    return self.parse_advanced(date, *json_list)
 
-      try:
-        merged_df = df1.merge(df2, on='股號', how='inner')
-        merged_df = merged_df.merge(df3, on='股號', how='inner')
-        time.sleep(2)
-        return merged_df
-      except Exception as e:
-        print(f"Error during merging dataframes: {e}")
+  # 將三個來源的 JSON 轉為 DataFrame 並合併
+  def parse_advanced(self, date, json_data1, json_data2, json_data3):
+    # 有資料才執行程式
+    for json_data in (json_data1, json_data2, json_data3):
+      if not ('stat' in json_data and json_data['stat'] == 'OK'):
+        print(f"{date} 無資料：{json_data.get('stat')}")
         return pd.DataFrame()
+    # 取得本益比資料
+    df1 = pd.DataFrame(json_data1['data'], columns=json_data1['fields'])
+    df1 = df1[['證券代號','殖利率(%)','本益比','股價淨值比']]
+    df1.insert(1, '日期', datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%d'))
+    df1.rename(columns={
+            '證券代號':'股號','殖利率(%)':'殖利率','本益比':'日本益比'
+            }, inplace=True)
+    # 取得法人買賣超資料
+    df2 = pd.DataFrame(json_data2['data'], columns=json_data2['fields'])
+    df2 = df2[['證券代號','三大法人買賣超股數']]
+    df2.rename(columns={
+            '證券代號':'股號'
+            }, inplace=True)
+    # 取得融資融券資料
+    data = pd.DataFrame(json_data3['tables'][1]['data'])
+    df3 = data.iloc[:, [0, 2, 9]]
+    df3.columns = ['股號', '融資買入', '融卷賣出']
+
+    try:
+      merged_df = df1.merge(df2, on='股號', how='inner')
+      merged_df = merged_df.merge(df3, on='股號', how='inner')
+      # 去除千分位並轉為數值, 無法轉換的(如 "-")設為 NaN
+      for column in ['殖利率', '日本益比', '股價淨值比', '三大法人買賣超股數', '融資買入', '融卷賣出']:
+        merged_df[column] = pd.to_numeric(merged_df[column].astype(str).str.replace(',', ''), errors='coerce')
+      return merged_df
+    except Exception as e:
+      print(f"Error during merging dataframes: {e}")
+      return pd.DataFrame()
+
+  # 多個交易日的進階日頻資料, 以執行緒池平行下載(共用限速器), 一次傳回全部結果
+  # 某一天重試後仍下載失敗時, 只傳回該日之前的資料, 下次 renew_daily 會從該日繼續
+  def stock_advanced_many(self, date_list):
+    df_list = []
+    with ThreadPoolExecutor(self.workers) as pool:
+      # 依日期順序送出請求, 限速器會依序放行
+      futures = {(date, i): pool.submit(self.get_json, url)
+                 for date in date_list
+                 for i, url in enumerate(self.advanced_urls(date))}
+      for date in date_list:
+        date_futures = [futures.pop((date, i)) for i in range(3)]
+        try:
+          json_list = [f.result() for f in date_futures]
+        except Exception as e:
+          print(f"{date} 下載失敗：{e}, 停止更新之後的日期")
+          for future in futures.values():
+            future.cancel()
+          break
+        df = self.parse_advanced(date, *json_list)
+        if not df.empty:
+          df_list.append(df)
+        print("完成更新:", date)
+    if not df_list:
+      return pd.DataFrame()
+    return pd.concat(df_list, ignore_index=True)
 
   # 更新日頻的基本資訊
   def renew_daily(self):
-    #找出最後更新日期
-    cursor = self.conn.execute('SELECT MAX(日期) FROM 日頻 WHERE 開盤價 IS NOT NULL')
+    #找出最後更新日期(以有證交所資料的日期為準, StockAnalysis 補上的股價不算)
+    cursor = self.conn.execute('SELECT MAX(日期) FROM 日頻 WHERE 融資買入 IS NOT NULL')
     m_date = cursor.fetchone()[0]
     print('日頻基本資料的最後更新日：', m_date)  #for debug
     if not m_date:
@@ -401,17 +913,108 @@ class StockDB:
     if len(date_list) == 0:
       print('不用更新!')
       return
-    advance_df = pd.DataFrame()
-    for date in date_list:
-      print("完成更新:", date)
-      df = self.stock_advanced(date)
-      advance_df = pd.concat([advance_df,df])
+    advance_df = self.stock_advanced_many(date_list)
+    if advance_df.empty:
+      print('證交所無資料, 不用更新!')
+      return
 
     # 所有表格
     final_df = pd.merge(base_df, advance_df, on=['日期', '股號'], how='inner')
     print(final_df)
-    final_df.to_sql('日頻', self.conn, if_exists='append', index=False)
+    self.upsert('日頻', final_df)
+    self.renew_derived() # 計算日報酬及技術指標
+    if self.columnar: # 只重建有新資料的年份
+      self.sync_columnar(final_df['日期'].str[:4].unique())
+
+
+  ##############################
+  ## 衍生資料：日報酬及技術指標 ##
+  ##############################
+
+  INDICATOR_WINDOW = 252 # 計算指標需要的最長歷史(52 週約 252 個交易日)
+
+  # 計算尚未有指標的日頻資料：填入日報酬, 並寫入指標表
+  # 每檔股票只讀取需要更新的日期, 加上前面 INDICATOR_WINDOW 個交易日的歷史
+  # 平常只找指標最後日期(含)之後的日頻資料; backfill=True 或指標表為空時才比對整個日頻表
+  # (例如補進較舊的歷史資料後)
+  def renew_derived(self, backfill=False):
+    self.create_indicator_table()
+    last = None if backfill else self.conn.execute('SELECT MAX(日期) FROM 指標').fetchone()[0]
+    # 每檔股票第一個尚未計算指標的日期
+    # 只找最後日期之後時以日期索引範圍查詢(否則 GROUP BY 股號 會讓查詢規劃改為掃描整個主鍵索引)
+    cursor = self.conn.execute(f'''
+    SELECT d.股號, MIN(d.日期) FROM 日頻 d {'' if last is None else 'INDEXED BY 日期索引'}
+    LEFT JOIN 指標 i ON d.股號 = i.股號 AND d.日期 = i.日期
+    WHERE i.股號 IS NULL {'' if last is None else 'AND d.日期 >= ?'}
+    GROUP BY d.股號''', () if last is None else (last,))
+    first_dates = {}
+    for stock, date in cursor.fetchall():
+      first_dates.setdefault(date, []).append(stock)
+    if not first_dates:
+      return print("指標不用更新")
+
+    # 起始日期相同的股票一起計算(每天更新時通常只有一組)
+    for first_date, stocks in first_dates.items():
+      cursor = self.conn.execute('''
+      SELECT DISTINCT 日期 FROM 日頻 WHERE 日期 < ?
+      ORDER BY 日期 DESC LIMIT 1 OFFSET ?''', (first_date, self.INDICATOR_WINDOW - 1))
+      row = cursor.fetchone()
+      history_start = row[0] if row else None
+      df = self.get('日頻', ['股號', '日期', '還原價', '成交量'], stocks=stocks, start=history_start)
+      df = self.compute_indicators(df)
+      df = df[df['日期'] >= first_date]
+
+      with self.lock, self.conn:
+        self.conn.executemany('UPDATE 日頻 SET 日報酬 = ? WHERE 股號 = ? AND 日期 = ?',
+                              df[['日報酬', '股號', '日期']].astype(object)
+                              .where(df[['日報酬', '股號', '日期']].notna(), None)
+                              .itertuples(index=False, name=None))
+      self.upsert('指標', df.drop(columns=['還原價', '成交量', '日報酬']))
+
+  # 以向量化的 groupby/rolling 計算日報酬及技術指標, df 需有 股號/日期/還原價/成交量 欄位
+  @staticmethod
+  def compute_indicators(df):
+    df = df.sort_values(['股號', '日期'], ignore_index=True)
+    price = pd.to_numeric(df['還原價'], errors='coerce')
+    volume = pd.to_numeric(df['成交量'], errors='coerce')
+    stock = df['股號']
+
+    def rolling(series, window, func, min_periods=None):
+      r = series.groupby(stock, sort=False).rolling(window, min_periods=min_periods)
+      return getattr(r, func)().reset_index(level=0, drop=True).sort_index()
+
+    df['日報酬'] = price.groupby(stock, sort=False).pct_change()
+    df['均線5'] = rolling(price, 5, 'mean')
+    df['均線20'] = rolling(price, 20, 'mean')
+    df['均線60'] = rolling(price, 60, 'mean')
+    df['波動率20'] = rolling(df['日報酬'], 20, 'std') * 252 ** 0.5 # 年化波動率
+    df['均量20'] = rolling(volume, 20, 'mean')
+    df['高52週'] = rolling(price, 252, 'max', min_periods=1)
+    df['低52週'] = rolling(price, 252, 'min', min_periods=1)
+    return df
+
+  # 以季頻一次計算全部股票的營收成長率、EPS 及 EPS 季增率, 寫入基本面表
+  def renew_fundamentals(self):
+    df = self.get('季頻', ['股號', '季末日', '營業收入', '每股盈餘'])
+    if df.empty:
+      return print("季頻沒有資料")
+    self.upsert('基本面', self.compute_fundamentals(df))
 
+  # 依股號、季末日排序後, 以分組的 pct_change 計算季增率(與前一季比較)
+  @staticmethod
+  def compute_fundamentals(df):
+    df = df.sort_values(['股號', '季末日'], ignore_index=True)
+    revenue = pd.to_numeric(df['營業收入'], errors='coerce')
+    eps = pd.to_numeric(df['每股盈餘'], errors='coerce')
+    stock = df['股號']
+    return pd.DataFrame({
+        '股號': stock,
+        '季末日': df['季末日'],
+        '營業收入': revenue,
+        '營收成長率': revenue.groupby(stock, sort=False).pct_change(fill_method=None).round(2),
+        'EPS': eps.round(2),
+        'EPS季增率': eps.groupby(stock, sort=False).pct_change(fill_method=None).round(2),
+    })
 
   # 顯示所有資料表的結構及索引資訊
   def table_info(self):
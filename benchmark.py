@@ -0,0 +1,409 @@
+import io
+import os
+import json
+import time
+import types
+import argparse
+import platform
+import sqlite3
+import tempfile
+import threading
+import statistics
+import contextlib
+import subprocess
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import Stock_DB
+from Stock_DB import StockDB, pa
+from http_util import HttpCache
+from universe import TickerUniverse
+from screening import ScreeningWorkspace
+
+
+# StockDB 的離線效能測試
+# 產生指定大小的合成資料庫, 以本機的模擬伺服器取代 ISIN、證交所及 Yahoo 股市, 並以模擬物件取代 yfinance,
+# 量測 get、renew_*、table_check 及選股流程的耗時, 結果寫成 JSON 以便比較不同版本
+# 用法：python benchmark.py --stocks 1000 --years 10 --out result.json
+
+
+# 合成的市場資料：股號、股價(隨機漫步)、財報及各資料來源的回應
+class SyntheticMarket:
+  INDUSTRIES = ['水泥工業', '食品工業', '塑膠工業', '紡織纖維', '電機機械', '半導體業', '電腦及週邊設備業', '金融保險業']
+
+  # gap_days: 資料庫最後幾個交易日留空, 供 renew_daily 更新
+  def __init__(self, stocks=1000, years=10, gap_days=5, seed=0, today=None):
+    self.rng = np.random.default_rng(seed)
+    self.ids = [str(1101 + i) for i in range(stocks)]
+    self.names = {id: f'合成{id}' for id in self.ids}
+    self.industries = {id: self.INDUSTRIES[i % len(self.INDUSTRIES)] for i, id in enumerate(self.ids)}
+    self.today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    self.start = self.today - timedelta(days=365 * years)
+    days = self.business_days(self.start, self.today)
+    self.db_end = days[-gap_days - 1] if gap_days < len(days) else days[0]
+    self.base_price = self.rng.uniform(10, 600, stocks)
+
+  @staticmethod
+  def business_days(start, end):
+    return pd.bdate_range(start, end).strftime('%Y-%m-%d').tolist()
+
+  # 一段日期的日頻資料(股價延續上一段), 欄位同日頻資料表(不含日報酬)
+  def daily_frame(self, dates):
+    n_dates, n_stocks = len(dates), len(self.ids)
+    returns = self.rng.normal(0, 0.02, (n_dates, n_stocks))
+    close = self.base_price * np.exp(np.cumsum(returns, axis=0))
+    self.base_price = close[-1]
+    spread = np.abs(self.rng.normal(0, 0.01, (n_dates, n_stocks)))
+    return pd.DataFrame({
+      '股號': np.tile(self.ids, n_dates),
+      '日期': np.repeat(dates, n_stocks),
+      '開盤價': (close * (1 + self.rng.normal(0, 0.005, close.shape))).round(2).ravel(),
+      '最高價': (close * (1 + spread)).round(2).ravel(),
+      '最低價': (close * (1 - spread)).round(2).ravel(),
+      '收盤價': close.round(2).ravel(),
+      '還原價': close.round(2).ravel(),
+      '成交量': self.rng.integers(1000, 5_000_000, close.size),
+      '殖利率': self.rng.uniform(0, 8, close.size).round(2),
+      '日本益比': self.rng.uniform(5, 40, close.size).round(2),
+      '股價淨值比': self.rng.uniform(0.5, 6, close.size).round(2),
+      '三大法人買賣超股數': self.rng.integers(-1_000_000, 1_000_000, close.size).astype(float),
+      '融資買入': self.rng.integers(0, 500_000, close.size).astype(float),
+      '融卷賣出': self.rng.integers(0, 100_000, close.size).astype(float),
+    })
+
+  # 早於 (year, quarter) 的所有季度
+  def quarters_before(self, year, quarter):
+    expected = int(year) * 10 + int(quarter[1])
+    return [(str(y), f'Q{q}') for y in range(self.start.year, int(year) + 1) for q in range(1, 5)
+            if y * 10 + q < expected]
+
+  def quarterly_frame(self, quarters):
+    rows = len(quarters) * len(self.ids)
+    revenue = self.rng.uniform(1e5, 1e8, rows).round(0)
+    return pd.DataFrame({
+      '股號': np.repeat(self.ids, len(quarters)),
+      '年份': [y for _ in self.ids for y, _ in quarters],
+      '季度': [q for _ in self.ids for _, q in quarters],
+      '營業收入': revenue,
+      '營業費用': (revenue * self.rng.uniform(0.05, 0.3, rows)).round(0),
+      '稅後淨利': (revenue * self.rng.uniform(-0.05, 0.25, rows)).round(0),
+      '每股盈餘': self.rng.normal(2, 2, rows).round(2),
+    })
+
+  def company_frame(self):
+    return pd.DataFrame({
+      '股號': self.ids,
+      '股名': [self.names[id] for id in self.ids],
+      '產業別': [self.industries[id] for id in self.ids],
+      '股本': self.rng.integers(10**8, 10**11, len(self.ids)),
+      '市值': self.rng.integers(10**9, 10**13, len(self.ids)),
+    })
+
+  ## 各資料來源的模擬回應 ##
+
+  def isin_html(self):
+    rows = ['<tr><td>有價證券代號及名稱</td><td>國際證券辨識號碼(ISIN Code)</td><td>上市日</td>'
+            '<td>市場別</td><td>產業別</td><td>CFICode</td><td>備註</td></tr>',
+            '<tr><td colspan=7><B>股票<B></td></tr>']
+    rows += [f'<tr><td>{id}　{self.names[id]}</td><td>TW000{id}001</td><td>2000/01/01</td>'
+             f'<td>上市</td><td>{self.industries[id]}</td><td>ESVUFR</td><td></td></tr>' for id in self.ids]
+    rows.append('<tr><td colspan=7><B>上市認購(售)權證<B></td></tr>')
+    return '<table>' + ''.join(rows) + '</table>'
+
+  def twse_json(self, path, date):
+    rng = np.random.default_rng(int(date))
+    n = len(self.ids)
+    if path.endswith('BWIBBU_d'):
+      values = rng.uniform(0, 40, (n, 3)).round(2)
+      return {'stat': 'OK', 'date': date,
+              'fields': ['證券代號', '證券名稱', '收盤價', '殖利率(%)', '股利年度', '本益比', '股價淨值比', '財報年/季'],
+              'data': [[id, self.names[id], '100.00', f'{v[0]:.2f}', '113', f'{v[1]:.2f}', f'{v[2] / 6:.2f}', '113/2']
+                       for id, v in zip(self.ids, values)]}
+    if path.endswith('T86'):
+      values = rng.integers(-1_000_000, 1_000_000, n)
+      return {'stat': 'OK', 'date': date,
+              'fields': ['證券代號', '證券名稱', '外陸資買賣超股數', '投信買賣超股數', '自營商買賣超股數', '三大法人買賣超股數'],
+              'data': [[id, self.names[id], '0', '0', '0', f'{v:,}'] for id, v in zip(self.ids, values)]}
+    values = rng.integers(0, 500_000, (n, 2))
+    return {'stat': 'OK', 'date': date,
+            'tables': [{'title': '信用交易統計', 'data': []},
+                       {'title': '融資融券彙總',
+                        'data': [[id, self.names[id], f'{v[0]:,}', '0', '0', '0', '0', '0', '0', f'{v[1]:,}',
+                                  '0', '0', '0', '0', '0', ''] for id, v in zip(self.ids, values)]}]}
+
+  # Yahoo 股市的損益表及 EPS 頁面(只含最新一季)
+  def yahoo_html(self, id, page, year, quarter):
+    rng = np.random.default_rng(int(id))
+    if page == 'eps':
+      header, rows = ['年度/季別', '每股盈餘'], [[f'{year} {quarter}', f'{rng.normal(2, 2):.2f}']]
+    else:
+      revenue = rng.uniform(1e5, 1e8)
+      header = ['年度/季別', f'{year} {quarter}']
+      rows = [['營業收入', f'{revenue:,.0f}'], ['營業毛利', f'{revenue * 0.3:,.0f}'],
+              ['營業費用', f'{revenue * 0.1:,.0f}'], ['營業利益', f'{revenue * 0.2:,.0f}'],
+              ['稅後淨利', f'{revenue * 0.15:,.0f}']]
+    items = ''.join('<li class="List(n)">' + ''.join(f'<span>{cell}</span>' for cell in row) + '</li>'
+                    for row in rows)
+    return (f'<html><body><section id="qsp-{page}-table"><div class="table-header">'
+            + ''.join(f'<span>{cell}</span>' for cell in header)
+            + f'</div><ul>{items}</ul></section></body></html>')
+
+  ## 取代 yfinance 的模擬函式 ##
+
+  def download(self, tickers, start=None, end=None, **kwargs):
+    if isinstance(tickers, str):
+      tickers = [tickers]
+    dates = pd.DatetimeIndex(self.business_days(start, self.today), name='Date')
+    rng = np.random.default_rng(len(dates))
+    shape = (len(dates), len(tickers))
+    close = rng.uniform(10, 600, shape).round(2)
+    fields = {'Adj Close': close, 'Close': close, 'High': (close * 1.01).round(2),
+              'Low': (close * 0.99).round(2), 'Open': close, 'Volume': rng.integers(1000, 5_000_000, shape)}
+    columns = pd.MultiIndex.from_product([list(fields), tickers], names=['Price', 'Ticker'])
+    return pd.DataFrame(np.hstack(list(fields.values())), index=dates, columns=columns)
+
+  def ticker(self, symbol):
+    rng = np.random.default_rng(int(symbol.split('.')[0]))
+    return types.SimpleNamespace(info={'sharesOutstanding': int(rng.integers(10**8, 10**11)),
+                                       'marketCap': int(rng.integers(10**9, 10**13))})
+
+
+# 本機模擬伺服器：/isin/...、/rwd/zh/...、/quote/{股號}.TW/{頁面}
+# report_quarter 為 Yahoo 頁面上的最新一季, 建立資料庫後再設定
+class StubServer:
+  def __init__(self, market, port=0):
+    self.market = market
+    self.report_quarter = None
+    self.requests = 0
+    stub = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def do_GET(self):
+        stub.requests += 1
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith('/isin/'):
+          body, ctype = stub.market.isin_html(), 'text/html; charset=utf-8'
+        elif url.path.startswith('/rwd/'):
+          body, ctype = json.dumps(stub.market.twse_json(url.path, query['date']), ensure_ascii=False), 'application/json'
+        elif url.path.startswith('/quote/'):
+          _, _, symbol, page = url.path.split('/')
+          body = stub.market.yahoo_html(symbol.split('.')[0], page, *stub.report_quarter)
+          ctype = 'text/html; charset=utf-8'
+        else:
+          self.send_error(404)
+          return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    self.server.daemon_threads = True
+    self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+  # 啟動伺服器, 並將 StockDB、TickerUniverse 及 yfinance 導向模擬資料, 結束時還原
+  @contextlib.contextmanager
+  def patch(self):
+    thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    thread.start()
+    saved = (StockDB.TWSE_URL, StockDB.YAHOO_URL, TickerUniverse.ISIN_URL, Stock_DB.yf)
+    StockDB.TWSE_URL = self.url
+    StockDB.YAHOO_URL = self.url
+    TickerUniverse.ISIN_URL = f'{self.url}/isin/C_public.jsp?strMode=2'
+    Stock_DB.yf = types.SimpleNamespace(download=self.market.download, Ticker=self.market.ticker)
+    try:
+      yield self
+    finally:
+      StockDB.TWSE_URL, StockDB.YAHOO_URL, TickerUniverse.ISIN_URL, Stock_DB.yf = saved
+      self.server.shutdown()
+      self.server.server_close()
+
+
+# 量測並記錄結果
+class Benchmark:
+  def __init__(self, verbose=False):
+    self.verbose = verbose
+    self.results = []
+
+  # 執行 func repeat 次, 記錄最短及中位數秒數; 傳回最後一次的結果
+  def measure(self, name, func, repeat=1, **info):
+    seconds = []
+    result = None
+    for _ in range(repeat):
+      output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+      with output:
+        started = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - started)
+    record = {'名稱': name, '秒數': round(min(seconds), 4), '中位數': round(statistics.median(seconds), 4),
+              '次數': repeat, **info}
+    if isinstance(result, int):
+      record['筆數'] = result
+    elif hasattr(result, '__len__'):
+      record['筆數'] = len(result)
+    self.results.append(record)
+    print(f"{name:<40} {record['秒數']:>10.4f} 秒" + (f"  {record['筆數']:,} 筆" if '筆數' in record else ''))
+    return result
+
+
+# 建立合成資料庫：公司、日頻(依年份分批寫入)、季頻, 並計算日報酬、指標及基本面
+def build_database(bench, market, db_path, http):
+  db = StockDB(db_path, db_start_date=market.start.strftime('%Y-%m-%d'), http=http, fast_ingest=True)
+  report_quarter = db.report_quarter()
+  bench.measure('寫入 公司', lambda: db.upsert('公司', market.company_frame()))
+  days = market.business_days(market.start, market.db_end)
+  years = sorted({day[:4] for day in days})
+
+  def write_daily():
+    rows = 0
+    for year in years:
+      rows += db.upsert('日頻', market.daily_frame([day for day in days if day[:4] == year]))
+    return rows
+  bench.measure('寫入 日頻', write_daily)
+  bench.measure('寫入 季頻', lambda: db.upsert('季頻', market.quarterly_frame(market.quarters_before(*report_quarter))))
+  bench.measure('renew_derived(全部)', db.renew_derived)
+  bench.measure('renew_fundamentals', db.renew_fundamentals)
+  return db
+
+
+# 選股流程的範例策略：大市值且營收成長最高(同 ai_helper 的範例)及近一個月動能
+SAMPLE_STRATEGIES = {
+  '營收成長': '''
+def calculate(table_company, table_daily, table_quarterly):
+    table_quarterly['營業收入'] = pd.to_numeric(table_quarterly['營業收入'], errors='coerce')
+    latest_two_dates = table_quarterly['日期'].drop_duplicates().sort_values(ascending=False).head(2)
+    recent_two_quarters_data = table_quarterly[table_quarterly['日期'].isin(latest_two_dates)].copy()
+    recent_two_quarters_data['營業收入成長率'] = recent_two_quarters_data.groupby('股號')['營業收入'].pct_change()
+    df = pd.merge(table_company, recent_two_quarters_data[['股號', '營業收入成長率']], on='股號', how='left')
+    df['市值'] = pd.to_numeric(df['市值'], errors='coerce')
+    top_10_percent_market_cap = df.nlargest(int(len(df) * 0.1), '市值')
+    return top_10_percent_market_cap.sort_values(by='營業收入成長率', ascending=False).head(10)
+''',
+  '月動能': '''
+def calculate(table_company, table_daily, table_quarterly):
+    recent = table_daily[table_daily['日期'] >= table_daily['日期'].max() - pd.Timedelta(days=30)]
+    momentum = recent.groupby('股號', observed=True)['收盤價'].agg(['first', 'last'])
+    momentum['報酬'] = momentum['last'] / momentum['first'] - 1
+    return momentum.nlargest(10, '報酬').reset_index()
+''',
+}
+
+
+def run(args):
+  workdir = args.workdir or tempfile.mkdtemp(prefix='stockdb_bench_')
+  os.makedirs(workdir, exist_ok=True)
+  db_path = os.path.join(workdir, 'stock.db')
+  # 每次都從空的資料庫及股號快照開始
+  for path in (db_path, db_path + '-wal', db_path + '-shm', os.path.join(workdir, 'cache', 'universe.json')):
+    if os.path.exists(path):
+      os.remove(path)
+  market = SyntheticMarket(args.stocks, args.years, args.gap_days, args.seed)
+  bench = Benchmark(args.verbose)
+  http = HttpCache(args.http_cache or os.path.join(workdir, 'cache', 'http'), mode=args.cache_mode)
+  print(f"合成資料庫：{args.stocks} 檔 × {args.years} 年, 工作目錄 {workdir}")
+
+  with StubServer(market, args.port).patch() as stub:
+    db = build_database(bench, market, db_path, http)
+    stub.report_quarter = db.report_quarter()
+    db.limiter.rate = args.rate
+    db.workers = args.workers
+    ids = market.ids
+    year_ago = (market.today - timedelta(days=365)).strftime('%Y-%m-%d')
+    month_ago = (market.today - timedelta(days=30)).strftime('%Y-%m-%d')
+
+    # 查詢
+    bench.measure('get 公司', lambda: db.get('公司'), args.repeat)
+    bench.measure('get 日頻 單一股票全部', lambda: db.get('日頻', stocks=ids[0]), args.repeat)
+    bench.measure('get 日頻 100 檔近一年', lambda: db.get('日頻', ['股號', '日期', '收盤價'],
+                                                     stocks=ids[:100], start=year_ago), args.repeat)
+    bench.measure('get 日頻 全部股票近一個月', lambda: db.get('日頻', start=month_ago, psdate=True), args.repeat)
+    bench.measure('get 日頻 條件式', lambda: db.get('日頻', ['股號', '日期', '成交量'],
+                                                where='成交量 > 4000000', start=year_ago), args.repeat)
+    bench.measure('get 季頻 psdate', lambda: db.get('季頻', psdate=True), args.repeat)
+    bench.measure('get 指標 單一股票', lambda: db.get('指標', stocks=ids[0]), args.repeat)
+    bench.measure('iter_get 日頻 全部(rows)', lambda: sum(len(rows) for rows in db.iter_get(
+        '日頻', ['股號', '日期', '收盤價'], rows=True)), args.repeat)
+    if pa is not None:
+      bench.measure('sync_columnar', db.sync_columnar)
+      bench.measure('get 日頻 100 檔近一年(columnar)', lambda: db.get(
+          '日頻', ['股號', '日期', '收盤價'], stocks=ids[:100], start=year_ago, engine='columnar'), args.repeat)
+
+    # 更新(資料來自模擬伺服器)
+    bench.measure('stock_name', lambda: db.stock_name())
+    bench.measure('url_find', lambda: db.url_find(f'{db.YAHOO_URL}/quote/{ids[0]}.TW/eps'))
+    bench.measure('stock_advanced', lambda: db.stock_advanced(market.today.strftime('%Y%m%d')))
+    bench.measure('renew_company(all)', lambda: db.renew_company(all=True, workers=args.workers))
+    bench.measure('renew_daily', db.renew_daily, gap_days=args.gap_days)
+    bench.measure('renew_quarterly_frequency_basic',
+                  lambda: db.renew_quarterly_frequency_basic(workers=args.workers, parse_workers=args.parse_workers))
+    bench.measure('table_check', db.table_check, args.repeat)
+
+    # 選股流程
+    workspace = bench.measure('ScreeningWorkspace 載入', lambda: ScreeningWorkspace(db))
+    for name, code in SAMPLE_STRATEGIES.items():
+      bench.measure(f'選股 {name}', lambda: workspace.run(code, memory=False), args.repeat)
+    bench.measure('ScreeningWorkspace refresh', workspace.refresh)
+    requests = stub.requests
+    db.close()
+
+  return {
+    '設定': {'股票數': args.stocks, '年數': args.years, '留空交易日': args.gap_days, '種子': args.seed,
+             '限速': args.rate, '執行緒': args.workers, '解析行程': args.parse_workers,
+             '快取模式': args.cache_mode, '重複次數': args.repeat},
+    '環境': environment(),
+    '資料庫大小MB': round(os.path.getsize(db_path) / 1024 ** 2, 1),
+    '模擬伺服器請求數': requests,
+    '結果': bench.results,
+  }
+
+
+# 執行環境, 供比較不同機器或版本的結果
+def environment():
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    commit = None
+  return {'時間': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+          'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+          'sqlite': sqlite3.sqlite_version, 'pyarrow': pa.__version__ if pa is not None else None,
+          '平台': platform.platform(), 'CPU': os.cpu_count()}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='StockDB 離線效能測試')
+  parser.add_argument('--stocks', type=int, default=200, help='股票數')
+  parser.add_argument('--years', type=int, default=3, help='日頻資料的年數')
+  parser.add_argument('--gap-days', type=int, default=5, help='留給 renew_daily 更新的交易日數')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--rate', type=float, default=1000, help='對模擬伺服器每秒的請求數上限')
+  parser.add_argument('--workers', type=int, default=8)
+  parser.add_argument('--parse-workers', type=int, default=4)
+  parser.add_argument('--repeat', type=int, default=3, help='查詢類項目的重複次數')
+  parser.add_argument('--cache-mode', default='off', choices=['off', 'normal', 'record', 'replay'],
+                      help='HttpCache 模式; replay 搭配 --http-cache 及 --port 可重播錄製的回應')
+  parser.add_argument('--http-cache', help='HttpCache 目錄(預設在工作目錄中)')
+  parser.add_argument('--port', type=int, default=0, help='模擬伺服器的連接埠(快取以網址為鍵, 錄製及重播需相同)')
+  parser.add_argument('--workdir', help='資料庫所在目錄(預設為暫存目錄)')
+  parser.add_argument('--out', help='結果 JSON 的路徑')
+  parser.add_argument('--verbose', action='store_true', help='顯示 StockDB 的輸出')
+  args = parser.parse_args(argv)
+
+  result = run(args)
+  out = args.out or f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+  with open(out, 'w', encoding='utf-8') as f:
+    json.dump(result, f, ensure_ascii=False, indent=1)
+  print(f"結果已寫入 {out}")
+  return result
+
+
+if __name__ == '__main__':
+  main()
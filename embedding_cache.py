@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+import faiss
+from langchain_core.embeddings import Embeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+
+# 向量快取(SQLite), 以 模型+文字 的 SHA-256 為鍵, 向量以 float32 位元組存放
+class EmbeddingStore:
+  def __init__(self, path='/content/drive/MyDrive/StockGPT/cache/embeddings.db'):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 向量 (
+        鍵 TEXT PRIMARY KEY NOT NULL,
+        維度 INTEGER,
+        資料 BLOB
+    )''')
+    self.conn.commit()
+
+  @staticmethod
+  def key(model, text):
+    return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+  # 傳回 {鍵: 向量}, 只含已快取的鍵
+  def get_many(self, keys):
+    result = {}
+    keys = list(keys)
+    with self.lock:
+      for i in range(0, len(keys), 500): # SQLite 參數數量有上限, 分批查詢
+        batch = keys[i:i + 500]
+        rows = self.conn.execute(f"SELECT 鍵, 資料 FROM 向量 WHERE 鍵 IN ({', '.join('?' * len(batch))})",
+                                 batch).fetchall()
+        result.update((key, np.frombuffer(data, dtype=np.float32)) for key, data in rows)
+    return result
+
+  def put_many(self, vectors):
+    with self.lock, self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO 向量 VALUES (?,?,?)',
+                            [(key, len(vector), np.asarray(vector, dtype=np.float32).tobytes())
+                             for key, vector in vectors.items()])
+
+
+# 有快取的 Embeddings, 可包裝任何 LangChain 的 Embeddings(例如 OpenAIEmbeddings())
+# 只有快取中沒有的文字才會呼叫模型, 且每次最多送出 batch_size 筆
+# 測試時可包裝 DeterministicFakeEmbedding(size=...), 不必連網
+# symmetric: 查詢與文件的向量相同(如 OpenAI), 多個查詢可合併成一次請求並共用快取
+class CachedEmbeddings(Embeddings):
+  def __init__(self, embeddings, store=None, model=None, batch_size=256, symmetric=True):
+    self.embeddings = embeddings
+    self.symmetric = symmetric
+    self.store = store or EmbeddingStore()
+    self.model = model or self.model_name(embeddings)
+    self.batch_size = batch_size
+    self.hits = 0
+    self.misses = 0
+
+  # 快取鍵中的模型名稱; 有指定維度時加上維度, 沒有 model 屬性時以 repr 區分參數(例如 size)不同的模型
+  @staticmethod
+  def model_name(embeddings):
+    name = getattr(embeddings, 'model', None)
+    if not name:
+      return repr(embeddings)
+    dimensions = getattr(embeddings, 'dimensions', None)
+    return f'{name}/{dimensions}' if dimensions else name
+
+  # 傳回 float32 矩陣(每列一個向量)
+  def embed_matrix(self, texts, kind='doc'):
+    if kind == 'query' and self.symmetric:
+      kind = 'doc'
+    keys = [self.store.key(f'{self.model}/{kind}', text) for text in texts]
+    cached = self.store.get_many(set(keys))
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in cached:
+        missing.setdefault(key, text)
+    self.hits += sum(key in cached for key in keys)
+    self.misses += len(missing)
+    items = list(missing.items())
+    for i in range(0, len(items), self.batch_size):
+      batch = items[i:i + self.batch_size]
+      if kind == 'query':
+        vectors = [self.embeddings.embed_query(text) for _, text in batch]
+      else:
+        vectors = self.embeddings.embed_documents([text for _, text in batch])
+      fetched = {key: np.asarray(vector, dtype=np.float32) for (key, _), vector in zip(batch, vectors)}
+      self.store.put_many(fetched)
+      cached.update(fetched)
+    if not keys:
+      return np.empty((0, 0), dtype=np.float32)
+    return np.vstack([cached[key] for key in keys])
+
+  def embed_documents(self, texts):
+    return self.embed_matrix(texts).tolist()
+
+  def embed_query(self, text):
+    return self.embed_matrix([text], 'query')[0].tolist()
+
+
+# 區塊的識別碼：來源、頁碼及內文相同的區塊視為同一個
+def chunk_id(doc):
+  meta = doc.metadata
+  text = f"{meta.get('source')}|{meta.get('page')}|{doc.page_content}"
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# 以快取的向量建立(或增量更新) FAISS 索引
+# db 為既有的索引時, 只加入其中沒有的區塊, 並刪除已不在 docs 中的區塊
+# embeddings 為 CachedEmbeddings; 向量分批取得並加入索引, 不必一次保留全部的向量
+def build_index(docs, embeddings, db=None):
+  docs = list({chunk_id(doc): doc for doc in docs}.items()) # 去除重複的區塊
+  if db is not None:
+    wanted = {id for id, _ in docs}
+    stale = [id for id in db.index_to_docstore_id.values() if id not in wanted]
+    if stale:
+      db.delete(stale)
+    docs = [(id, doc) for id, doc in docs if id not in db.docstore._dict]
+  for i in range(0, len(docs), embeddings.batch_size):
+    batch = docs[i:i + embeddings.batch_size]
+    texts = [doc.page_content for _, doc in batch]
+    vectors = embeddings.embed_matrix(texts)
+    if db is None:
+      db = FAISS(embeddings, faiss.IndexFlatL2(vectors.shape[1]), InMemoryDocstore(), {})
+    db.add_embeddings(zip(texts, vectors), metadatas=[doc.metadata for _, doc in batch],
+                      ids=[id for id, _ in batch])
+  return db
@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+import requests
+
+
+# 權杖桶(token bucket)限速器, 可由多個執行緒共用
+# rate: 每秒補充的權杖數(即平均每秒可發出的請求數), burst: 桶容量(可連續發出的請求數)
+# 證交所約每 5 秒超過 3 次請求就可能封鎖 IP, 因此預設為每秒 0.6 次且不允許連發:
+# 任 5 秒內最多 burst + 5 * rate 次, burst=3 時開頭 5 秒可發出 5 次, burst=1 時為 3 次
+class RateLimiter:
+  def __init__(self, rate=0.6, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  # 取得一個權杖, 權杖不足時等待
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+# 發送 GET 請求, 失敗時以指數退避(backoff)重試
+# limiter: 共用的限速器, 每次嘗試前都會先取得權杖
+# parse: 解析回應的函式(例如 lambda r: r.json()), 解析失敗也會重試
+def get_with_retry(url, limiter=None, retries=3, backoff=2, timeout=30, parse=None, **kwargs):
+  for attempt in range(retries + 1):
+    if limiter is not None:
+      limiter.acquire()
+    try:
+      response = requests.get(url, timeout=timeout, **kwargs)
+      if response.status_code == 429 or response.status_code >= 500:
+        raise requests.HTTPError(f"狀態碼 {response.status_code}", response=response)
+      return parse(response) if parse else response
+    except (requests.RequestException, ValueError) as e:
+      if attempt == retries:
+        raise
+      wait = backoff * 2 ** attempt + random.uniform(0, 1)
+      print(f"請求失敗({e}), {wait:.1f} 秒後重試：{url}")
+      time.sleep(wait)
+
+
+# 快取中找不到資料(重播模式下不會連網)
+class CacheMissError(requests.RequestException):
+  pass
+
+
+# 從快取取出的回應, 提供與 requests.Response 相同的 status_code/content/text/json()
+class CachedResponse:
+  def __init__(self, url, status_code, content, headers, encoding, from_cache):
+    self.url = url
+    self.status_code = status_code
+    self.content = content
+    self.headers = headers
+    self.encoding = encoding
+    self.from_cache = from_cache
+
+  @property
+  def text(self):
+    return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+  def json(self):
+    return json.loads(self.content)
+
+
+# 證交所的歷史日期資料不會再變動, 可永久快取; 但 stat 不是 OK 的回應(查無資料、尚未公布)
+# 以及當天(或之後)的資料只快取 10 分鐘, 以免暫時的缺漏變成永久缺少該日資料
+def twse_ttl(url, content=None):
+  match = re.search(r'date=(\d{8})', url)
+  if match and match.group(1) < datetime.now().strftime('%Y%m%d') and twse_ok(content):
+    return None
+  return 600
+
+
+# 證交所的回應是否為 stat 為 OK 的 JSON
+def twse_ok(content):
+  try:
+    return json.loads(content).get('stat') == 'OK'
+  except (TypeError, ValueError, AttributeError):
+    return False
+
+
+# 各端點的快取時間(秒), 依序比對網址, None 表示永久有效, 也可以是傳入 (網址, 快取內容) 的函式
+DEFAULT_TTL_RULES = [
+  (r'isin\.twse\.com\.tw', 86400),           # 股號清單：1 天
+  (r'www\.twse\.com\.tw/rwd/', twse_ttl),    # 證交所日資料：歷史日期永久有效
+  (r'tw\.stock\.yahoo\.com/quote/', 86400),  # Yahoo 財報頁面：1 天
+  (r'api\.cnyes\.com/', 600),                # 新聞列表：10 分鐘
+]
+
+
+# 共用的 HTTP 回應快取
+# 回應內容以 SHA-256 為檔名存放(相同內容只存一份), 索引則存於 SQLite
+# mode: 'normal' 依 TTL 使用快取, 過期時以 ETag/Last-Modified 條件式請求重新驗證
+#       'record' 一律連網並更新快取, 'replay' 只讀快取(離線、結果可重現), 'off' 不使用快取
+# max_bytes: 快取總大小上限, 超過時依最久未使用(LRU)刪除
+class HttpCache:
+  def __init__(self, cache_dir='/content/drive/MyDrive/StockGPT/cache/http', mode='normal',
+               max_bytes=1024 ** 3, ttl_rules=None, default_ttl=3600):
+    self.cache_dir = cache_dir
+    self.blob_dir = os.path.join(cache_dir, 'blobs')
+    os.makedirs(self.blob_dir, exist_ok=True)
+    self.mode = mode
+    self.max_bytes = max_bytes
+    self.ttl_rules = DEFAULT_TTL_RULES if ttl_rules is None else ttl_rules
+    self.default_ttl = default_ttl
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'),
+                                check_same_thread=False, timeout=30)
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS entries (
+        url TEXT PRIMARY KEY NOT NULL,
+        hash TEXT, status INTEGER, headers TEXT, encoding TEXT,
+        etag TEXT, last_modified TEXT,
+        fetched REAL, accessed REAL, size INTEGER
+    )''')
+    self.conn.commit()
+
+  # 依網址(及快取的內容)取得快取時間
+  def ttl(self, url, content=None):
+    for pattern, ttl in self.ttl_rules:
+      if re.search(pattern, url):
+        return ttl(url, content) if callable(ttl) else ttl
+    return self.default_ttl
+
+  def blob_path(self, digest):
+    return os.path.join(self.blob_dir, digest[:2], digest)
+
+  # 取得網址的內容, fetch(url, headers) 為實際連網的函式(預設為 get_with_retry)
+  def get(self, url, fetch=None):
+    if self.mode == 'off':
+      return self.fetch(url, fetch, {})
+    with self.lock:
+      row = self.conn.execute('SELECT hash, status, headers, encoding, etag, last_modified, fetched '
+                              'FROM entries WHERE url = ?', (url,)).fetchone()
+    cached = self.load(url, row) if row else None
+    if self.mode == 'replay':
+      if cached is None:
+        raise CacheMissError(f"重播模式下快取中沒有：{url}")
+      return self.hit(url, cached)
+    if cached is not None and self.mode == 'normal':
+      ttl = self.ttl(url, cached.content)
+      if ttl is None or time.time() - row[6] < ttl:
+        return self.hit(url, cached)
+    # 過期或未快取：連網, 若有 ETag/Last-Modified 則發出條件式請求
+    headers = {}
+    if cached is not None and self.mode == 'normal':
+      if row[4]:
+        headers['If-None-Match'] = row[4]
+      if row[5]:
+        headers['If-Modified-Since'] = row[5]
+    response = self.fetch(url, fetch, headers)
+    if response.status_code == 304 and cached is not None:
+      with self.lock, self.conn:
+        self.conn.execute('UPDATE entries SET fetched = ?, accessed = ? WHERE url = ?',
+                          (time.time(), time.time(), url))
+      return self.hit(url, cached)
+    self.misses += 1
+    if response.status_code == 200:
+      self.store(url, response)
+    return response
+
+  # 連網取得資料
+  def fetch(self, url, fetch, headers):
+    if fetch is None:
+      return get_with_retry(url, headers=headers)
+    return fetch(url, headers)
+
+  def hit(self, url, cached):
+    self.hits += 1
+    with self.lock, self.conn:
+      self.conn.execute('UPDATE entries SET accessed = ? WHERE url = ?', (time.time(), url))
+    return cached
+
+  # 讀取快取的內容, 檔案遺失時傳回 None
+  def load(self, url, row):
+    digest, status, headers, encoding = row[:4]
+    try:
+      with open(self.blob_path(digest), 'rb') as f:
+        content = f.read()
+    except FileNotFoundError:
+      return None
+    return CachedResponse(url, status, content, json.loads(headers), encoding, True)
+
+  # 寫入快取, 內容以雜湊值為檔名
+  def store(self, url, response):
+    content = response.content
+    digest = hashlib.sha256(content).hexdigest()
+    path = self.blob_path(digest)
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      tmp = f"{path}.{threading.get_ident()}.tmp"
+      with open(tmp, 'wb') as f:
+        f.write(content)
+      os.replace(tmp, path)
+    now = time.time()
+    with self.lock, self.conn:
+      self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?,?,?,?)',
+                        (url, digest, response.status_code, json.dumps(dict(response.headers)),
+                         response.encoding, response.headers.get('ETag'),
+                         response.headers.get('Last-Modified'), now, now, len(content)))
+    self.evict()
+
+  # 超過大小上限時, 依最久未使用的順序刪除
+  def evict(self):
+    with self.lock, self.conn:
+      total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                                '(SELECT DISTINCT hash, size FROM entries)').fetchone()[0]
+      if total <= self.max_bytes:
+        return
+      rows = self.conn.execute('SELECT url, hash, size FROM entries ORDER BY accessed').fetchall()
+      refs = {}
+      for _, digest, _ in rows:
+        refs[digest] = refs.get(digest, 0) + 1
+      for url, digest, size in rows:
+        if total <= self.max_bytes:
+          break
+        self.conn.execute('DELETE FROM entries WHERE url = ?', (url,))
+        refs[digest] -= 1
+        if refs[digest] == 0: # 沒有其他網址共用此內容
+          total -= size
+          try:
+            os.remove(self.blob_path(digest))
+          except FileNotFoundError:
+            pass
+
+  # 刪除指定網址的快取
+  def invalidate(self, url):
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM entries WHERE url = ?', (url,))
+
+  # 快取統計
+  def stats(self):
+    with self.lock:
+      count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+    return {'命中': self.hits, '未命中': self.misses, '網址數': count, '位元組': size}
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+# LLM 回應的本機快取(SQLite)
+# 以 模型+訊息+參數 的標準化 JSON 計算 SHA-256 作為鍵, temperature=0 時相同輸入可直接重用回應
+# ttl: 有效秒數(None 表示永久), max_entries: 筆數上限, 超過時刪除最久未使用的資料
+class LLMCache:
+  def __init__(self, path='/content/drive/MyDrive/StockGPT/cache/llm.db', ttl=7 * 86400, max_entries=10000):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.saved_seconds = 0.0 # 命中時省下的原始呼叫時間
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 回應 (
+        鍵 TEXT PRIMARY KEY NOT NULL,
+        模型 TEXT,
+        內容 TEXT,
+        耗時 REAL,
+        建立時間 REAL,
+        使用時間 REAL
+    )''')
+    self.conn.commit()
+
+  # 標準化後的雜湊鍵：鍵值排序、去除多餘空白, 確保相同內容得到相同的鍵
+  @staticmethod
+  def key(model, messages, **params):
+    text = json.dumps({'model': model, 'messages': messages, 'params': params},
+                      sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+  # 取出快取的回應, 沒有或已過期時傳回 None
+  def get(self, key):
+    now = time.time()
+    with self.lock:
+      row = self.conn.execute('SELECT 內容, 耗時, 建立時間 FROM 回應 WHERE 鍵 = ?', (key,)).fetchone()
+      if row is None or (self.ttl is not None and now - row[2] > self.ttl):
+        self.misses += 1
+        return None
+      with self.conn:
+        self.conn.execute('UPDATE 回應 SET 使用時間 = ? WHERE 鍵 = ?', (now, key))
+      self.hits += 1
+      self.saved_seconds += row[1] or 0
+    return row[0]
+
+  # 寫入回應及原始呼叫的耗時
+  def put(self, key, model, content, seconds):
+    now = time.time()
+    with self.lock, self.conn:
+      self.conn.execute('INSERT OR REPLACE INTO 回應 VALUES (?,?,?,?,?,?)',
+                        (key, model, content, seconds, now, now))
+      count = self.conn.execute('SELECT COUNT(*) FROM 回應').fetchone()[0]
+      if count > self.max_entries:
+        self.conn.execute('DELETE FROM 回應 WHERE 鍵 IN '
+                          '(SELECT 鍵 FROM 回應 ORDER BY 使用時間 LIMIT ?)', (count - self.max_entries,))
+      if self.ttl is not None:
+        self.conn.execute('DELETE FROM 回應 WHERE 建立時間 < ?', (now - self.ttl,))
+
+  # 有快取就直接傳回, 否則呼叫 call() 並寫入快取
+  def cached(self, key, model, call):
+    content = self.get(key)
+    if content is not None:
+      return content
+    start = time.perf_counter()
+    content = call()
+    self.put(key, model, content, time.perf_counter() - start)
+    return content
+
+  # 快取統計
+  def stats(self):
+    with self.lock:
+      count = self.conn.execute('SELECT COUNT(*) FROM 回應').fetchone()[0]
+    total = self.hits + self.misses
+    return {'命中': self.hits, '未命中': self.misses,
+            '命中率': self.hits / total if total else 0.0,
+            '省下秒數': round(self.saved_seconds, 2), '筆數': count}
@@ -0,0 +1,111 @@
+import os
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import pdfplumber
+from langchain_core.documents import Document
+
+
+# 在工作行程中擷取一段頁面(start ~ end-1)的文字, 傳回 [(頁碼, 內文, 秒數)]
+def extract_range(path, start, end):
+  pages = []
+  with pdfplumber.open(path) as pdf:
+    for page in pdf.pages[start:end]:
+      started = time.perf_counter()
+      text = page.extract_text() or ''
+      pages.append((page.page_number - 1, text, time.perf_counter() - started))
+      page.close() # 釋放該頁解析後的物件, 避免記憶體隨頁數累積
+  return pages
+
+
+# 檔案內容的 SHA-256(分段讀取)
+def file_hash(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+# 頁面文字快取(SQLite), 以 檔案雜湊+頁碼 為鍵; 同一份 PDF 改變切塊大小時不必重新解析
+class PageTextCache:
+  def __init__(self, path='/content/drive/MyDrive/StockGPT/cache/pages.db'):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 頁面 (
+        檔案雜湊 TEXT NOT NULL,
+        頁碼 INTEGER NOT NULL,
+        內文 TEXT,
+        秒數 REAL,
+        PRIMARY KEY (檔案雜湊, 頁碼)
+    )''')
+    self.conn.execute('''
+    CREATE TABLE IF NOT EXISTS 檔案 (
+        檔案雜湊 TEXT PRIMARY KEY NOT NULL,
+        頁數 INTEGER
+    )''')
+    self.conn.commit()
+
+  # 傳回 [(頁碼, 內文, 秒數)], 沒有完整快取時傳回 None
+  def get(self, digest):
+    with self.lock:
+      row = self.conn.execute('SELECT 頁數 FROM 檔案 WHERE 檔案雜湊 = ?', (digest,)).fetchone()
+      if row is None:
+        return None
+      pages = self.conn.execute('SELECT 頁碼, 內文, 秒數 FROM 頁面 WHERE 檔案雜湊 = ? ORDER BY 頁碼',
+                                (digest,)).fetchall()
+    return pages if len(pages) == row[0] else None
+
+  # 寫入整份檔案的頁面
+  def put(self, digest, pages):
+    with self.lock, self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO 頁面 VALUES (?,?,?,?)',
+                            [(digest, page, text, seconds) for page, text, seconds in pages])
+      self.conn.execute('INSERT OR REPLACE INTO 檔案 VALUES (?,?)', (digest, len(pages)))
+
+
+# 以多個行程平行擷取 PDF 文字
+# 頁面分成數段(每段最多 pages_per_task 頁)交給行程池, 結果依檔案雜湊快取
+# 每頁的解析秒數記錄於 page_times, 可找出特別慢的頁面
+class PdfTextExtractor:
+  def __init__(self, cache=None, workers=None, pages_per_task=16):
+    self.cache = cache or PageTextCache()
+    self.workers = workers or os.cpu_count() or 1
+    self.pages_per_task = pages_per_task
+    self.page_times = [] # 最近一次擷取的 [(頁碼, 秒數)]
+
+  # 傳回各頁的 Document(格式同 PDFPlumberLoader)
+  def load(self, path):
+    started = time.perf_counter()
+    digest = file_hash(path)
+    pages = self.cache.get(digest)
+    if pages is None:
+      pages = self.extract(path)
+      self.cache.put(digest, pages)
+      source = '解析'
+    else:
+      source = '快取'
+    self.page_times = [(page, seconds) for page, _, seconds in pages]
+    slowest = sorted(self.page_times, key=lambda item: -item[1])[:3]
+    print(f"{os.path.basename(path)}：{len(pages)} 頁({source}), {time.perf_counter() - started:.2f} 秒, "
+          f"最慢的頁面 {', '.join(f'第 {page + 1} 頁 {seconds:.2f} 秒' for page, seconds in slowest)}")
+    return [Document(page_content=text + '\n',
+                     metadata={'source': path, 'file_path': path, 'page': page, 'total_pages': len(pages)})
+            for page, text, _ in pages]
+
+  # 將頁面分段, 以行程池擷取
+  def extract(self, path):
+    with pdfplumber.open(path) as pdf:
+      total = len(pdf.pages)
+    size = max(1, min(self.pages_per_task, math.ceil(total / self.workers)))
+    ranges = [(start, min(start + size, total)) for start in range(0, total, size)]
+    if len(ranges) <= 1:
+      return [page for start, end in ranges for page in extract_range(path, start, end)]
+    with ProcessPoolExecutor(min(self.workers, len(ranges))) as pool:
+      results = pool.map(extract_range, [path] * len(ranges), *zip(*ranges))
+      return [page for pages in results for page in pages]
@@ -0,0 +1,124 @@
+import re
+import math
+import numbers
+import threading
+try: # 精確計算 tokens 需要 tiktoken, 沒有時改用估計值
+  import tiktoken
+except ImportError:
+  tiktoken = None
+
+
+# 計算文字的 tokens 數
+# 有 tiktoken 時使用模型對應的編碼; 否則以 中日韓字元 1 個 token、其他字元 4 個 1 個 token 估計
+class TokenCounter:
+  _encodings = {}
+  _lock = threading.Lock()
+
+  def __init__(self, model='gpt-3.5-turbo'):
+    self.model = model
+    self.encoding = self.load_encoding(model)
+
+  # 同一個模型的編碼只載入一次; 載入失敗(例如離線無法下載編碼檔)時傳回 None
+  @classmethod
+  def load_encoding(cls, model):
+    if tiktoken is None:
+      return None
+    with cls._lock:
+      if model not in cls._encodings:
+        try:
+          cls._encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception as e:
+          print(f"無法載入 {model} 的 tiktoken 編碼, 改用估計值：{e}")
+          cls._encodings[model] = None
+      return cls._encodings[model]
+
+  def count(self, text):
+    if not text:
+      return 0
+    if self.encoding is not None:
+      return len(self.encoding.encode(text))
+    cjk = len(re.findall(r'[　-鿿가-힯＀-￯]', text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+  # 截斷文字使其不超過 budget 個 tokens, 盡量在句尾(。！？或換行)切開
+  def truncate(self, text, budget):
+    if budget <= 0:
+      return ''
+    if self.count(text) <= budget:
+      return text
+    result = ''
+    for sentence in re.split(r'(?<=[。！？!?\n])', text):
+      if self.count(result + sentence) > budget:
+        break
+      result += sentence
+    if not result: # 第一句就超過預算, 依比例切開
+      result = text[:max(1, len(text) * budget // self.count(text))]
+      while result and self.count(result) > budget:
+        result = result[:-1]
+    return result
+
+
+# 組成 StockGPT 的資料訊息
+# 數值以四捨五入後的表格呈現(取代 Python 的 repr), 比例欄位轉為百分比
+# 新聞內文依每段的 tokens 預算截斷, 並記錄各段的 tokens 數
+class PromptBuilder:
+  PERCENT_COLUMNS = {'每日報酬', '營收成長率', 'EPS 季增率', 'EPS季增率'}
+
+  # news_budget: 新聞段的 tokens 上限(平均分給各則新聞, 標題及日期不截斷)
+  # digits: 數值保留的小數位數
+  def __init__(self, model='gpt-3.5-turbo', news_budget=1500, digits=2):
+    self.counter = TokenCounter(model)
+    self.news_budget = news_budget
+    self.digits = digits
+
+  # 將 {欄名: 串列} 轉為以 | 分隔的表格, 長度不足的欄位以 - 補齊
+  def table(self, data):
+    if not data:
+      return '無資料'
+    columns = list(data)
+    rows = max(len(values) for values in data.values())
+    header = [f'{column}(%)' if column in self.PERCENT_COLUMNS else column for column in columns]
+    lines = ['|'.join(header)]
+    for i in range(rows):
+      cells = []
+      for column in columns:
+        value = data[column][i] if i < len(data[column]) else None
+        cells.append(self.format_value(value, column in self.PERCENT_COLUMNS))
+      lines.append('|'.join(cells))
+    return '\n'.join(lines)
+
+  def format_value(self, value, percent=False):
+    if value is None or (isinstance(value, numbers.Real) and math.isnan(value)):
+      return '-'
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+      value = float(value) * (100 if percent else 1)
+      text = f'{value:.{self.digits}f}'
+      return text.rstrip('0').rstrip('.') if '.' in text else text
+    return str(value)
+
+  # 新聞：每則一行標題(含日期)及截斷後的內文
+  def news(self, news_data):
+    if not news_data:
+      return '無資料'
+    per_item = self.news_budget // len(news_data)
+    lines = []
+    for _, date, title, body in news_data:
+      lines.append(f'[{date}] {title}')
+      body = self.counter.truncate(' '.join(body.split()), per_item)
+      if body:
+        lines.append(body)
+    return '\n'.join(lines)
+
+  # 依序組合各段 [(段名, 標題, 內容)], 傳回 (訊息, 各段 tokens 數的報告)
+  def build(self, sections, closing=''):
+    parts = []
+    report = {}
+    for name, heading, body in sections:
+      text = f'{heading}\n{body}\n' if heading else f'{body}\n'
+      parts.append(text)
+      report[name] = self.counter.count(text)
+    parts.append(closing)
+    report['結尾'] = self.counter.count(closing)
+    message = ''.join(parts)
+    report['合計'] = self.counter.count(message)
+    return message, report
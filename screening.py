@@ -0,0 +1,146 @@
+import time
+import textwrap
+import contextlib
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+# 選股用的記憶體內資料(ai_helper 產生的 calculate 函式)
+# 公司、日頻、季頻三個資料表只從 StockDB 讀取一次並常駐記憶體：
+# 股號為共用類別的 categorical, 浮點數欄位縮減為 float32(不損失精度時才縮減), 日期已解析,
+# 日頻依 (股號, 日期) 排序; renew 之後以 refresh() 只讀取新增及近期變動的資料
+# 傳給 calculate 的股號會轉回字串欄位(同 db.get), 產生的程式碼不必處理 categorical
+# 用法：ws = ScreeningWorkspace(db); result = ws.run(calculate)
+class ScreeningWorkspace:
+  # 資料庫中為數值的欄位; 整欄都是 NULL 時 SQLite 會讀成物件型別, 先轉回數值
+  NUMERIC_COLUMNS = {'股本', '市值', '開盤價', '最高價', '最低價', '收盤價', '還原價', '成交量',
+                     '日報酬', '殖利率', '日本益比', '股價淨值比', '三大法人買賣超股數',
+                     '融資買入', '融卷賣出', '營業收入', '營業費用', '稅後淨利', '每股盈餘'}
+
+  # start: 日頻資料的起始日期(None 表示全部)
+  # overlap: refresh 時重新讀取的天數(近期資料可能在之後才補上融資、法人等欄位)
+  def __init__(self, db, start=None, overlap=7):
+    self.db = db
+    self.start = start
+    self.overlap = overlap
+    self.runs = [] # 每次 run 的統計
+    self.load()
+
+  # 讀取三個資料表
+  def load(self):
+    started = time.perf_counter()
+    self.table_company = self.db.get('公司')
+    self.table_daily = self.db.get('日頻', psdate=True, start=self.start)
+    self.table_quarterly = self.db.get('季頻', psdate=True)
+    self.optimize()
+    print(f"載入選股資料：{time.perf_counter() - started:.2f} 秒, {self.memory_mb():.1f} MB")
+
+  # renew 之後只讀取最後 overlap 天以後的日頻資料, 取代記憶體中的同期資料
+  # 公司及季頻資料量小, 直接重新讀取
+  def refresh(self):
+    started = time.perf_counter()
+    daily = self.table_daily
+    if len(daily):
+      since = daily['日期'].max() - pd.Timedelta(days=self.overlap)
+      recent = self.db.get('日頻', psdate=True, start=since.date().isoformat())
+      old = daily[daily['日期'] < since]
+      stock_type = self.stock_type([old, recent])
+      old = old.assign(股號=old['股號'].cat.set_categories(stock_type.categories))
+      recent['股號'] = recent['股號'].astype(stock_type)
+      self.table_daily = pd.concat([old, recent], ignore_index=True)
+    else:
+      self.table_daily = self.db.get('日頻', psdate=True, start=self.start)
+      recent = self.table_daily
+    self.table_company = self.db.get('公司')
+    self.table_quarterly = self.db.get('季頻', psdate=True)
+    self.optimize()
+    print(f"更新選股資料：讀取 {len(recent)} 筆日頻, {time.perf_counter() - started:.2f} 秒")
+
+  # 各資料表股號的聯集, 作為共用的類別
+  @staticmethod
+  def stock_type(tables):
+    ids = set()
+    for df in tables:
+      column = df['股號']
+      ids.update(column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column.unique())
+    return pd.CategoricalDtype(sorted(ids))
+
+  # 統一股號類別、縮減數值型別並排序
+  def optimize(self):
+    tables = (self.table_company, self.table_daily, self.table_quarterly)
+    stock_type = self.stock_type(tables)
+    for df in tables:
+      if isinstance(df['股號'].dtype, pd.CategoricalDtype): # 已是類別時只調整類別, 不必逐筆轉換
+        df['股號'] = df['股號'].cat.set_categories(stock_type.categories)
+      else:
+        df['股號'] = df['股號'].astype(stock_type)
+      for column in df.columns:
+        if column in self.NUMERIC_COLUMNS and not pd.api.types.is_numeric_dtype(df[column]):
+          df[column] = pd.to_numeric(df[column], errors='coerce')
+        # 浮點數只在轉回 float64 完全相同時才縮為 float32; 整數維持 int64, 避免產生的程式碼運算時溢位
+        if pd.api.types.is_float_dtype(df[column]) and df[column].dtype != np.float32:
+          values = df[column].to_numpy(dtype=np.float64)
+          small = values.astype(np.float32)
+          if np.array_equal(small.astype(np.float64), values, equal_nan=True):
+            df[column] = small
+    self.table_daily = self.table_daily.sort_values(['股號', '日期'], kind='stable', ignore_index=True)
+
+  # 三個資料表佔用的記憶體(MB)
+  def memory_mb(self):
+    tables = (self.table_company, self.table_daily, self.table_quarterly)
+    return sum(df.memory_usage(deep=True).sum() for df in tables) / 1024 ** 2
+
+  # pandas 3 起一律為 copy-on-write; 2.x 要開啟選項, 淺層複製才不會被 calculate 的修改影響
+  @staticmethod
+  def copy_on_write():
+    if int(pd.__version__.split('.')[0]) >= 3:
+      return contextlib.nullcontext()
+    return pd.option_context('mode.copy_on_write', True)
+
+  # 傳給 calculate 的三個資料表：淺層複製, 股號轉回字串欄位(類別只存一份, 不會複製字串)
+  # 須在 copy_on_write() 之中呼叫及使用
+  def views(self):
+    return [df.assign(股號=df['股號'].astype(df['股號'].cat.categories.dtype))
+            for df in (self.table_company, self.table_daily, self.table_quarterly)]
+
+  # 執行 calculate(table_company, table_daily, table_quarterly), 可傳入函式或 ai_helper 產生的程式碼字串
+  # 傳入的是 views(), calculate 新增或修改欄位不會影響常駐的資料
+  # memory=True 時以 tracemalloc 記錄峰值記憶體(會讓計算稍慢)
+  def run(self, calculate, memory=True):
+    if isinstance(calculate, str):
+      calculate = self.compile(calculate)
+    with self.copy_on_write():
+      return self.measure(calculate, memory)
+
+  # 執行並記錄秒數、峰值記憶體及筆數
+  def measure(self, calculate, memory):
+    views = self.views()
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+      tracemalloc.start()
+    elif memory:
+      tracemalloc.reset_peak()
+    started = time.perf_counter()
+    try:
+      result = calculate(*views)
+    finally:
+      seconds = time.perf_counter() - started
+      peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if memory else None
+      if tracing:
+        tracemalloc.stop()
+    stats = {'秒數': round(seconds, 4), '峰值記憶體MB': None if peak is None else round(peak, 1),
+             '筆數': len(result) if hasattr(result, '__len__') else None}
+    self.runs.append(stats)
+    self.last_run = stats
+    print(f"選股計算：{stats['秒數']} 秒, 峰值記憶體 {stats['峰值記憶體MB']} MB, 結果 {stats['筆數']} 筆")
+    return result
+
+  # 執行程式碼字串, 取出其中的 calculate 函式
+  @staticmethod
+  def compile(code):
+    namespace = {'pd': pd, 'np': np}
+    exec(textwrap.dedent(code).strip(), namespace)
+    if 'calculate' not in namespace:
+      raise ValueError("程式碼中沒有 calculate 函式")
+    return namespace['calculate']
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import traceback
+import tracemalloc
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from screening import ScreeningWorkspace
+try: # 限制工作行程記憶體需要 resource(僅 Unix)
+  import resource
+except ImportError:
+  resource = None
+
+
+# 在工作行程中執行 calculate 並將結果傳回(由 fork 繼承 workspace 的資料, 不必複製)
+# 峰值記憶體以 tracemalloc 從工作行程開始時起算, 只含策略本身配置的記憶體
+# (ru_maxrss 會包含父行程的最高用量, 無法看出策略用了多少)
+def run_strategy(conn, workspace, code, memory_mb):
+  try:
+    address_space = StrategyExecutor.address_space()
+    if resource is not None and memory_mb and address_space is not None:
+      # fork 後的位址空間已包含繼承的資料, 上限為目前用量再加上 memory_mb
+      limit = address_space + memory_mb * 1024 ** 2
+      resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    calculate = ScreeningWorkspace.compile(code)
+    tracemalloc.start()
+    with workspace.copy_on_write():
+      views = workspace.views()
+      started = time.perf_counter()
+      result = calculate(*views)
+      seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    conn.send(('ok', result, seconds, peak))
+  except MemoryError:
+    conn.send(('error', f"MemoryError: 超過記憶體上限 {memory_mb} MB", None, None))
+  except BaseException:
+    conn.send(('error', traceback.format_exc(limit=-3), None, None))
+  finally:
+    conn.close()
+
+
+# 產生的選股策略的執行引擎
+# 1. 程式碼在 fork 的工作行程中執行, 有執行時間(timeout 秒)及記憶體(memory_mb)上限, 不會卡住呼叫端
+# 2. 驗證成功的程式碼依需求的雜湊值快取, 相同需求不必再呼叫 LLM 產生及除錯
+# 3. 執行失敗時自動以 ai_debug 修正, 最多嘗試 max_attempts 次, 每次的耗時記錄於 attempts
+# 用法：executor = StrategyExecutor(analysis, ScreeningWorkspace(db)); result = executor.solve('選出...')
+class StrategyExecutor:
+  def __init__(self, analysis, workspace, timeout=60, memory_mb=4096, max_attempts=3,
+               cache_path='/content/drive/MyDrive/StockGPT/cache/strategies.json'):
+    self.analysis = analysis
+    self.workspace = workspace
+    self.timeout = timeout
+    self.memory_mb = memory_mb
+    self.max_attempts = max_attempts
+    self.cache_path = cache_path
+    self.cache = {}
+    if os.path.exists(cache_path):
+      with open(cache_path, encoding='utf-8') as f:
+        self.cache = json.load(f)
+    self.attempts = [] # 最近一次 solve 的各次嘗試
+
+  # 目前行程的虛擬記憶體大小(位元組); 沒有 /proc 的平台(如 macOS)傳回 None, 不限制記憶體
+  @staticmethod
+  def address_space():
+    try:
+      with open('/proc/self/status') as f:
+        for line in f:
+          if line.startswith('VmSize:'):
+            return int(line.split()[1]) * 1024
+    except OSError:
+      pass
+    return None
+
+  # 需求的雜湊值(忽略前後及連續空白)
+  @staticmethod
+  def requirement_key(user_msg):
+    return hashlib.sha256(' '.join(user_msg.split()).encode('utf-8')).hexdigest()
+
+  # 在工作行程中執行程式碼, 傳回 (結果, 執行秒數, 峰值記憶體MB); 失敗時引發例外
+  def execute(self, code):
+    if 'fork' not in mp.get_all_start_methods(): # 不支援 fork 的平台直接在本行程執行(無時間及記憶體上限)
+      started = time.perf_counter()
+      result = self.workspace.run(code, memory=False)
+      return result, time.perf_counter() - started, None
+    ctx = mp.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=run_strategy,
+                          args=(child_conn, self.workspace, code, self.memory_mb), daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+      if not parent_conn.poll(self.timeout):
+        raise TimeoutError(f"執行超過 {self.timeout} 秒")
+      status, result, seconds, peak = parent_conn.recv()
+    except EOFError:
+      process.join()
+      raise RuntimeError(f"工作行程異常結束(結束碼 {process.exitcode})")
+    finally:
+      if process.is_alive():
+        process.terminate()
+        process.join(5)
+        if process.is_alive():
+          process.kill()
+      process.join()
+      parent_conn.close()
+    if status != 'ok':
+      raise RuntimeError(result)
+    return result, seconds, peak
+
+  # 檢查結果是否符合要求：DataFrame 且數值欄位沒有 NaN 或 Inf
+  @staticmethod
+  def validate(result):
+    if not isinstance(result, pd.DataFrame):
+      raise ValueError(f"calculate 必須傳回 DataFrame, 但傳回了 {type(result).__name__}")
+    numeric = result.select_dtypes('number')
+    if result.isna().any().any() or np.isinf(numeric.to_numpy(dtype=float)).any():
+      raise ValueError("結果中含有 NaN 或 Inf")
+
+  # 依需求產生、執行及除錯, 傳回選股結果
+  def solve(self, user_msg):
+    key = self.requirement_key(user_msg)
+    self.attempts = []
+    if key in self.cache: # 已驗證過的程式碼, 資料更新後仍可能失敗, 失敗時重新產生
+      try:
+        return self.attempt(self.cache[key]['程式碼'], 0, '快取')
+      except Exception as e:
+        print(f"快取的程式碼執行失敗, 重新產生：{e}")
+        self.drop(key)
+
+    started = time.perf_counter()
+    history, code = self.analysis.ai_helper(user_msg)
+    generate_seconds = time.perf_counter() - started
+    for attempt in range(1, self.max_attempts + 1):
+      try:
+        result = self.attempt(code, generate_seconds, '產生' if attempt == 1 else '除錯')
+      except Exception as e:
+        if attempt == self.max_attempts:
+          raise RuntimeError(f"嘗試 {attempt} 次仍無法執行：{e}") from e
+        started = time.perf_counter()
+        code = self.analysis.ai_debug(history, code, str(e))
+        generate_seconds = time.perf_counter() - started
+        continue
+      self.save(key, user_msg, code)
+      return result
+
+  # 執行一次並記錄耗時
+  def attempt(self, code, generate_seconds, source):
+    record = {'嘗試': len(self.attempts) + 1, '來源': source, '產生秒數': round(generate_seconds, 2),
+              '執行秒數': None, '峰值記憶體MB': None, '錯誤': None}
+    self.attempts.append(record)
+    started = time.perf_counter()
+    try:
+      result, seconds, peak = self.execute(code)
+      self.validate(result)
+    except Exception as e:
+      record['執行秒數'] = round(time.perf_counter() - started, 2)
+      record['錯誤'] = str(e).strip().splitlines()[-1] if str(e).strip() else type(e).__name__
+      print(f"第 {record['嘗試']} 次({source})失敗：{record['錯誤']}")
+      raise
+    record['執行秒數'] = round(seconds, 2)
+    record['峰值記憶體MB'] = None if peak is None else round(peak, 1)
+    print(f"第 {record['嘗試']} 次({source})成功：產生 {record['產生秒數']} 秒, 執行 {record['執行秒數']} 秒")
+    return result
+
+  # 寫入快取(先寫暫存檔再取代)
+  def save(self, key, user_msg, code):
+    self.cache[key] = {'需求': user_msg, '程式碼': code, '時間': time.time()}
+    self.write_cache()
+
+  def drop(self, key):
+    self.cache.pop(key, None)
+    self.write_cache()
+
+  def write_cache(self):
+    os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+    tmp = self.cache_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+      json.dump(self.cache, f, ensure_ascii=False)
+    os.replace(tmp, self.cache_path)
@@ -0,0 +1,111 @@
+import os
+import re
+import json
+import html
+import time
+import threading
+import pandas as pd
+from bs4 import BeautifulSoup
+from http_util import HttpCache
+
+
+# 上市股票清單(股號、股名、產業別), 供 StockInfo 及 StockDB 共用
+# 解析結果存成本機快照(JSON), 在 ttl 秒內直接讀快照, 不必重新下載及解析 ISIN 網頁
+# 以 dict 建立 股號→股名 及 股名→股號 的索引, 查詢為 O(1)
+class TickerUniverse:
+  ISIN_URL = 'https://isin.twse.com.tw/isin/C_public.jsp?strMode=2'
+  _shared = {} # 同一個快照路徑在同一行程中只載入一次
+  _shared_lock = threading.Lock()
+
+  def __init__(self, snapshot='/content/drive/MyDrive/StockGPT/cache/universe.json', http=None, ttl=86400):
+    self.snapshot = snapshot
+    self.http = http
+    self.ttl = ttl
+    self.rows = None # [(股號, 股名, 產業別, 是否為股票區段)]
+    self.loaded_at = 0
+    self.lock = threading.Lock()
+
+  # 取得共用的實例
+  @classmethod
+  def shared(cls, snapshot='/content/drive/MyDrive/StockGPT/cache/universe.json', http=None, ttl=86400):
+    with cls._shared_lock:
+      if snapshot not in cls._shared:
+        cls._shared[snapshot] = cls(snapshot, http, ttl)
+      return cls._shared[snapshot]
+
+  # 確保資料在有效期限內：記憶體 → 快照 → 線上讀取
+  def load(self, force=False):
+    with self.lock:
+      if not force and self.rows is not None and time.time() - self.loaded_at < self.ttl:
+        return
+      if not force and os.path.exists(self.snapshot):
+        with open(self.snapshot, encoding='utf-8') as f:
+          data = json.load(f)
+        if time.time() - data['時間'] < self.ttl:
+          self.build(data['資料'], data['時間'])
+          return
+      print("線上讀取股號、股名、及產業別")
+      http = self.http or HttpCache()
+      rows = self.parse(http.get(self.ISIN_URL).text)
+      now = time.time()
+      os.makedirs(os.path.dirname(os.path.abspath(self.snapshot)), exist_ok=True)
+      tmp = self.snapshot + '.tmp'
+      with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'時間': now, '資料': rows}, f, ensure_ascii=False)
+      os.replace(tmp, self.snapshot)
+      self.build(rows, now)
+
+  # 建立索引
+  def build(self, rows, loaded_at):
+    self.rows = [tuple(row) for row in rows]
+    self.by_id = {row[0]: row for row in self.rows}
+    self.by_name = {row[1]: row[0] for row in self.rows}
+    self.loaded_at = loaded_at
+
+  # 解析 ISIN 網頁：以正規表示式直接擷取 <tr>/<td>, 不建立完整的 DOM
+  # 只保留 4 碼股號; 第一個區段(股票)之後的 ETF 等也會保留, 但標記為非股票
+  @staticmethod
+  def parse(text):
+    # 以 <tr 切開各列(不依賴結束標籤), 每格取到 </td> 或下一個 <td 為止
+    cell_re = re.compile(r'<td[^>]*>(.*?)(?=</td>|<td[\s>]|</tr>|$)', re.S | re.I)
+    tag_re = re.compile(r'<[^>]+>')
+    table = [[html.unescape(tag_re.sub('', c)) for c in cell_re.findall(row)]
+             for row in re.split(r'<tr[^>]*>', text, flags=re.I)[1:]]
+    if len(table) < 3: # 格式不符時改用 BeautifulSoup
+      soup = BeautifulSoup(text, 'html.parser')
+      table = [[td.text for td in tr.find_all('td')] for tr in soup.find_all('tr')]
+
+    rows = []
+    in_stocks = True
+    for cells in table[2:]:
+      if len(cells) < 5:
+        in_stocks = False
+        continue
+      parts = cells[0].split('\u3000')
+      stock_id = parts[0].strip()
+      if len(stock_id) != 4 or len(parts) < 2:
+        in_stocks = False
+        continue
+      rows.append((stock_id, parts[1], cells[4].strip(), in_stocks))
+    return rows
+
+  # 傳回 DataFrame(股號, 股名, 產業別), stocks_only=True 時只含股票區段
+  def frame(self, stocks_only=True):
+    self.load()
+    data = [row[:3] for row in self.rows if row[3] or not stocks_only]
+    return pd.DataFrame(data, columns=['股號', '股名', '產業別'])
+
+  # 股號 → 股名
+  def name(self, stock_id):
+    self.load()
+    return self.by_id[stock_id][1]
+
+  # 股名 → 股號
+  def id(self, stock_name):
+    self.load()
+    return self.by_name[stock_name]
+
+  # 股號 → 產業別
+  def industry(self, stock_id):
+    self.load()
+    return self.by_id[stock_id][2]
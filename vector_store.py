@@ -0,0 +1,111 @@
+import os
+import json
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+import faiss
+from langchain_community.vectorstores import FAISS
+
+
+# 已儲存的 FAISS 索引管理
+# 各索引以名稱存放於 db_dir/<名稱>, 並在 manifest.json 記錄建立時的簽章(來源檔雜湊、切塊參數、模型等)
+# 簽章相同時直接載入(索引檔以記憶體映射讀取), 不同時才重建(以舊索引為基礎增量更新)
+# 已載入的索引保留在記憶體中, 最多 max_loaded 個, 超過時移除最久未使用的
+class VectorStoreManager:
+  def __init__(self, embeddings, db_dir='/content/drive/MyDrive/StockGPT/DB/', max_loaded=4):
+    self.embeddings = embeddings
+    self.db_dir = db_dir
+    self.max_loaded = max_loaded
+    self.loaded = OrderedDict() # 名稱 → (簽章, 索引)
+    self.lock = threading.Lock()
+    self.manifest_path = os.path.join(db_dir, 'manifest.json')
+    self.manifest = {}
+    if os.path.exists(self.manifest_path):
+      with open(self.manifest_path, encoding='utf-8') as f:
+        self.manifest = json.load(f)
+
+  # 取得索引; build(old) 傳回新的索引, old 為可修改的舊索引(沒有時為 None)
+  def get(self, name, signature, build):
+    with self.lock:
+      if name in self.loaded and self.loaded[name][0] == signature:
+        self.loaded.move_to_end(name)
+        return self.loaded[name][1]
+    path = os.path.join(self.db_dir, name)
+    exists = os.path.exists(os.path.join(path, 'index.faiss'))
+    if exists and self.manifest.get(name) == signature:
+      db = self.load(path)
+      print(f"載入向量索引：{name}")
+    else:
+      db = build(self.load(path, mmap=False) if exists else None)
+      if db is None:
+        return None
+      self.save(db, path)
+      with self.lock:
+        self.manifest[name] = signature
+        self.write_manifest()
+      print(f"建立向量索引：{name}")
+    with self.lock:
+      self.loaded[name] = (signature, db)
+      self.loaded.move_to_end(name)
+      while len(self.loaded) > self.max_loaded:
+        self.loaded.popitem(last=False)
+    return db
+
+  # 讀取索引; mmap=True 時以記憶體映射讀取(唯讀, 不可再加入向量), 不支援時改為一般讀取
+  def load(self, path, mmap=True):
+    index = None
+    if mmap:
+      try:
+        index = faiss.read_index(os.path.join(path, 'index.faiss'),
+                                 getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP))
+      except RuntimeError:
+        index = None
+    if index is None:
+      index = faiss.read_index(os.path.join(path, 'index.faiss'))
+    with open(os.path.join(path, 'index.pkl'), 'rb') as f: # 由本程式儲存的檔案
+      docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(self.embeddings, index, docstore, index_to_docstore_id)
+
+  # 先寫到暫存目錄再逐檔取代, 已映射舊檔的索引仍可繼續使用
+  def save(self, db, path):
+    tmp = path + '.tmp'
+    db.save_local(tmp)
+    os.makedirs(path, exist_ok=True)
+    for name in ('index.faiss', 'index.pkl'):
+      os.replace(os.path.join(tmp, name), os.path.join(path, name))
+    os.rmdir(tmp)
+
+  # 從記憶體中移除
+  def evict(self, name=None):
+    with self.lock:
+      if name is None:
+        self.loaded.clear()
+      else:
+        self.loaded.pop(name, None)
+
+  def write_manifest(self):
+    tmp = self.manifest_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+      json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, self.manifest_path)
+
+
+# 以向量查詢索引, vectors 可一次包含多個查詢, 傳回每個查詢的 [(Document, 距離)]
+# filter(metadata) 為 True 的區塊才會被搜尋(先篩選再搜尋, 不會因篩選而少於 k 筆)
+def search(db, vectors, k, filter=None):
+  vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, db.index.d)
+  if db._normalize_L2:
+    faiss.normalize_L2(vectors)
+  params = None
+  if filter is not None:
+    positions = np.array([i for i, id in db.index_to_docstore_id.items()
+                          if filter(db.docstore.search(id).metadata)], dtype='int64')
+    if not len(positions):
+      return [[] for _ in vectors]
+    selector = faiss.IDSelectorBatch(positions)
+    params = faiss.SearchParameters(sel=selector)
+  scores, indices = db.index.search(vectors, k, params=params)
+  return [[(db.docstore.search(db.index_to_docstore_id[i]), float(score))
+           for score, i in zip(row_scores, row_indices) if i != -1]
+          for row_scores, row_indices in zip(scores, indices)]